@@ -37,16 +37,41 @@ to the resulting database
 
 """
 
+import array
+import base64
+import bisect
 import collections
+import copy
 import csv
+import fnmatch
+import functools
+import hashlib
+import heapq
+import importlib
+import io
+import itertools
+import json
 import locale
+import re
 import warnings
 import os
+import random
+import struct
 import sys
+import threading
+import timeit
 
 
 PY2 = sys.version_info[0] < 3
 
+if not PY2:
+    unichr = chr
+
+if PY2:
+    from collections import Mapping
+else:
+    from collections.abc import Mapping
+
 
 class SirutaCodeWarning(UserWarning):
     """
@@ -58,6 +83,747 @@ class SirutaCodeWarning(UserWarning):
     pass
 
 
+def _require(module):
+    """
+    Import an optional dependency, failing with a helpful message if
+    it is not installed.
+
+    """
+    try:
+        return importlib.import_module(module)
+    except ImportError:
+        raise ImportError("The %s module is required for this feature" % module)
+
+
+"""
+-----------------
+Columnar storage
+-----------------
+"""
+
+
+class _ColumnarRows(Mapping):
+    """
+    Read-only mapping from SIRUTA code to the entity dictionary, built
+    on top of one sequence per field instead of one dictionary per
+    entity. It can be used in place of ``SirutaDatabase._data``.
+
+    :param columns: dictionary of field name to column; every column \
+    must support ``len()`` and indexing
+    :param value: function extracting the python value at a given \
+    index from a column; plain indexing is used by default
+    :param to_list: function converting a whole column to a list
+    :param index: the :class:`_CodeIndex` of the ``siruta`` column, \
+    built from the column by default
+
+    """
+    def __init__(self, columns, value=None, to_list=None, index=None):
+        self._columns = columns
+        self._value = value or (lambda column, index: column[index])
+        self._to_list = to_list or list
+        self._codes = self._to_list(columns['siruta'])
+        self._index = index if index is not None else _CodeIndex(self._codes)
+
+    def __getitem__(self, siruta):
+        index = self._index.get(siruta)
+        if index is None:
+            raise KeyError(siruta)
+        return dict((field, self._value(column, index))
+                    for field, column in self._columns.items())
+
+    def __contains__(self, siruta):
+        return siruta in self._index
+
+    def __iter__(self):
+        return iter(self._codes)
+
+    def position(self, siruta):
+        """Return the index of an entity in the columns, or ``None``"""
+        return self._index.get(siruta)
+
+    def value(self, field, index):
+        """Return the ``field`` of the entity at the given index"""
+        return self._value(self._columns[field], index)
+
+    def __len__(self):
+        return len(self._codes)
+
+    def find(self, field, value):
+        """Return the codes of the entities whose ``field`` is ``value``"""
+        values = self._to_list(self._columns[field])
+        return [code for code, v in zip(self._codes, values) if v == value]
+
+    def columns(self):
+        """Return the stored columns as a dictionary of lists"""
+        return dict((field, self._to_list(column))
+                    for field, column in self._columns.items())
+
+    def clear(self):
+        """
+        Drop all the entities, e.g. before closing the buffer the
+        columns are read from
+
+        """
+        self._columns = dict((field, []) for field in self._columns)
+        self._codes = []
+        self._index = _CodeIndex([])
+
+
+class _CodeIndex(object):
+    """
+    Direct-address table from SIRUTA code to row index. The codes are
+    below one million, so the table is an array with one slot per code
+    between the smallest and the largest one, holding the row index or
+    a marker for missing codes. Lookups are a subtraction and an array
+    access, and the table can be stored in a flat buffer.
+
+    :param codes: the codes, in row order
+
+    """
+    _header = struct.Struct("<iII")
+
+    def __init__(self, codes):
+        self._count = len(codes)
+        self._base = min(codes) if codes else 0
+        size = max(codes) - self._base + 1 if codes else 0
+        typecode = 'H' if self._count < 0xFFFF else 'i'
+        self._missing = 0xFFFF if typecode == 'H' else -1
+        self._table = array.array(typecode, [self._missing]) * size
+        for row, code in enumerate(codes):
+            self._table[code - self._base] = row
+
+    def get(self, siruta, default=None):
+        """Return the row index of a code, or ``default``"""
+        try:
+            position = siruta - self._base
+            if type(position) is not int:
+                # e.g. 1017.0 or NumPy numbers, found like in a dict
+                if position != int(position):
+                    return default
+                position = int(position)
+        except (TypeError, ValueError, OverflowError):
+            return default
+        if 0 <= position < len(self._table):
+            row = self._table[position]
+            if row != self._missing:
+                return row
+        return default
+
+    def get_many(self, codes):
+        """Return the row indexes of several codes, ``None`` for the \
+        codes that are missing"""
+        get = self.get
+        return [get(code) for code in codes]
+
+    def __contains__(self, siruta):
+        return self.get(siruta) is not None
+
+    def __len__(self):
+        return self._count
+
+    def to_bytes(self):
+        """Serialize the table, see :meth:`from_buffer`"""
+        return self._header.pack(self._base, self._count, self._table.itemsize) + \
+            self._table.tobytes()
+
+    @classmethod
+    def from_buffer(cls, buffer):
+        """
+        Load a table written by :meth:`to_bytes` without copying it,
+        e.g. from a shared memory block
+
+        """
+        buffer = memoryview(buffer)
+        ret = cls.__new__(cls)
+        ret._base, ret._count, itemsize = cls._header.unpack(buffer[:cls._header.size])
+        typecode = 'H' if itemsize == 2 else 'i'
+        ret._missing = 0xFFFF if typecode == 'H' else -1
+        ret._table = buffer[cls._header.size:].cast(typecode)
+        return ret
+
+
+class _StringColumn(object):
+    """
+    Column of strings stored as one UTF-8 buffer and an array of
+    ``len + 1`` offsets into it. Strings are decoded on access.
+
+    """
+    def __init__(self, blob, offsets):
+        self._blob = blob
+        self._offsets = offsets
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index):
+        return bytes(self._blob[self._offsets[index]:
+                                self._offsets[index + 1]]).decode('utf-8')
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+
+class _BoolColumn(object):
+    """Column of booleans stored as one byte per value"""
+    def __init__(self, values):
+        self._values = values
+
+    def __len__(self):
+        return len(self._values)
+
+    def __getitem__(self, index):
+        return bool(self._values[index])
+
+    def __iter__(self):
+        for value in self._values:
+            yield bool(value)
+
+
+class _CategoryColumn(object):
+    """Column of a few distinct values, stored as one byte per value"""
+    def __init__(self, values):
+        self._categories = sorted(set(values))
+        positions = dict((value, i) for i, value in enumerate(self._categories))
+        self._codes = array.array('B', [positions[value] for value in values])
+
+    def __len__(self):
+        return len(self._codes)
+
+    def __getitem__(self, index):
+        return self._categories[self._codes[index]]
+
+    def __iter__(self):
+        for code in self._codes:
+            yield self._categories[code]
+
+
+def _write_varint(out, value):
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(buffer, position):
+    value = 0
+    shift = 0
+    while True:
+        byte = buffer[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+
+class _FrontCodedDictionary(object):
+    """
+    Sorted set of unique strings compressed with front coding: the
+    strings are split into blocks, the first string of every block is
+    stored in full and the others as the length of the prefix shared
+    with the previous string plus the remaining suffix. Random access
+    decodes at most one block; the block offsets allow binary search.
+
+    :param strings: the strings to store; duplicates are removed
+    :param block_size: the number of strings per block
+
+    """
+    _header = struct.Struct("<III")
+
+    def __init__(self, strings=(), block_size=8):
+        strings = sorted(set(value.encode('utf-8') for value in strings))
+        self._block_size = block_size
+        self._count = len(strings)
+        offsets = array.array('I')
+        data = bytearray()
+        previous = b""
+        for index, value in enumerate(strings):
+            if index % block_size == 0:
+                offsets.append(len(data))
+                shared = 0
+            else:
+                shared = 0
+                limit = min(len(previous), len(value))
+                while shared < limit and previous[shared] == value[shared]:
+                    shared += 1
+                _write_varint(data, shared)
+            _write_varint(data, len(value) - shared)
+            data.extend(value[shared:])
+            previous = value
+        self._offsets = offsets
+        self._data = bytes(data)
+
+    def __len__(self):
+        return self._count
+
+    def __decode_block(self, block, stop=None):
+        """Decode the strings of a block, up to index ``stop`` in it"""
+        position = self._offsets[block]
+        count = min(self._block_size, self._count - block * self._block_size)
+        if stop is not None:
+            count = min(count, stop + 1)
+        values = []
+        previous = b""
+        for index in range(count):
+            shared = 0
+            if index > 0:
+                shared, position = _read_varint(self._data, position)
+            length, position = _read_varint(self._data, position)
+            previous = previous[:shared] + bytes(self._data[position:position + length])
+            position += length
+            values.append(previous)
+        return values
+
+    def __getitem__(self, index):
+        if index < 0 or index >= self._count:
+            raise IndexError(index)
+        block, offset = divmod(index, self._block_size)
+        return self.__decode_block(block, offset)[offset].decode('utf-8')
+
+    def __iter__(self):
+        for block in range(len(self._offsets)):
+            for value in self.__decode_block(block):
+                yield value.decode('utf-8')
+
+    def find(self, value):
+        """Return the index of ``value`` or ``-1`` if it is not stored"""
+        value = value.encode('utf-8')
+        low, high = 0, len(self._offsets)
+        while low < high:
+            middle = (low + high) // 2
+            if self.__decode_block(middle, 0)[0] <= value:
+                low = middle + 1
+            else:
+                high = middle
+        if low == 0:
+            return -1
+        block = low - 1
+        values = self.__decode_block(block)
+        position = bisect.bisect_left(values, value)
+        if position < len(values) and values[position] == value:
+            return block * self._block_size + position
+        return -1
+
+    def to_bytes(self):
+        """Serialize the dictionary, see :meth:`from_buffer`"""
+        return self._header.pack(self._count, self._block_size, len(self._offsets)) + \
+            self._offsets.tobytes() + self._data
+
+    @classmethod
+    def from_buffer(cls, buffer):
+        """
+        Load a dictionary written by :meth:`to_bytes` without copying
+        the data, e.g. from a memory-mapped file
+
+        """
+        buffer = memoryview(buffer)
+        ret = cls.__new__(cls)
+        ret._count, ret._block_size, blocks = cls._header.unpack(buffer[:cls._header.size])
+        start = cls._header.size
+        ret._offsets = buffer[start:start + 4 * blocks].cast('I')
+        ret._data = buffer[start + 4 * blocks:]
+        return ret
+
+
+class _NameColumn(object):
+    """
+    Column of entity names stored as a type prefix number and a number
+    in a front-coded dictionary of the names without prefixes, so that
+    e.g. ``MUNICIPIUL SIBIU`` and ``SIBIU`` share their storage
+
+    :param names: the names
+    :param prefixes: the known name prefixes
+
+    """
+    def __init__(self, names, prefixes):
+        self._prefixes = [u""] + list(prefixes)
+        prefix_ids = array.array('B')
+        bases = []
+        for name in names:
+            prefix_id = 0
+            for index, prefix in enumerate(prefixes):
+                if name.startswith(prefix) and len(name) > len(prefix):
+                    prefix_id = index + 1
+                    name = name[len(prefix):]
+                    break
+            prefix_ids.append(prefix_id)
+            bases.append(name)
+        self._dictionary = _FrontCodedDictionary(bases)
+        self._prefix_ids = prefix_ids
+        self._base_ids = array.array('i', [self._dictionary.find(name) for name in bases])
+
+    def __len__(self):
+        return len(self._base_ids)
+
+    def __getitem__(self, index):
+        return self._prefixes[self._prefix_ids[index]] + \
+            self._dictionary[self._base_ids[index]]
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def to_parts(self):
+        """Serialize the column as the parts of a :func:`_pack_columns` field"""
+        prefixes = u"\n".join(self._prefixes[1:]).encode('utf-8')
+        return [('B', prefixes), ('B', self._prefix_ids.tobytes()),
+                ('i', self._base_ids.tobytes()), ('B', self._dictionary.to_bytes())]
+
+    @classmethod
+    def from_views(cls, views):
+        """Load a column written by :meth:`to_parts` without copying it"""
+        ret = cls.__new__(cls)
+        prefixes = bytes(views[0]).decode('utf-8')
+        ret._prefixes = [u""] + (prefixes.split(u"\n") if prefixes else [])
+        ret._prefix_ids = views[1]
+        ret._base_ids = views[2]
+        ret._dictionary = _FrontCodedDictionary.from_buffer(views[3])
+        return ret
+
+
+_PACK_MAGIC = b"SIRUTA03"
+
+
+def _pack_columns(columns, prefixes=()):
+    """
+    Serialize a dictionary of columns to a flat buffer that can be read
+    back without copying by :func:`_unpack_columns`. Integer columns are
+    stored as 32-bit arrays, booleans as bytes, names as a
+    :class:`_NameColumn` using ``prefixes`` and other strings as a UTF-8
+    buffer plus an offset array. The :class:`_CodeIndex` of the codes
+    is stored as well, as the ``_index`` column.
+
+    """
+    chunks = []
+    header = {}
+    position = 0
+    index = _CodeIndex(columns['siruta'])
+    for field, values in list(columns.items()) + [('_index', index)]:
+        if field == '_index':
+            parts = [('B', index.to_bytes())]
+        elif values and isinstance(values[0], bool):
+            parts = [('b', array.array('b', values).tobytes())]
+        elif values and isinstance(values[0], int):
+            parts = [('i', array.array('i', values).tobytes())]
+        elif field == 'name':
+            parts = _NameColumn(values, prefixes).to_parts()
+        else:
+            encoded = [value.encode('utf-8') for value in values]
+            offsets = array.array('i', [0])
+            for value in encoded:
+                offsets.append(offsets[-1] + len(value))
+            parts = [('i', offsets.tobytes()), ('B', b"".join(encoded))]
+        header[field] = []
+        for kind, data in parts:
+            header[field].append((kind, position, len(data)))
+            padding = -len(data) % 8
+            chunks.append(data + b"\0" * padding)
+            position += len(data) + padding
+    header = json.dumps(header).encode('utf-8')
+    header += b" " * (-len(header) % 8)
+    return b"".join([_PACK_MAGIC, struct.pack("<Q", len(header)), header] + chunks)
+
+
+def _unpack_columns(buffer):
+    """
+    Read a buffer written by :func:`_pack_columns`. The columns are
+    views over ``buffer``, which must stay alive as long as they do.
+    The code index is returned as the ``_index`` column.
+
+    """
+    buffer = memoryview(buffer)
+    if bytes(buffer[:8]) != _PACK_MAGIC:
+        raise ValueError("Not a SIRUTA column buffer")
+    size = struct.unpack("<Q", buffer[8:16])[0]
+    header = json.loads(bytes(buffer[16:16 + size]).decode('utf-8'))
+    start = 16 + size
+    columns = {}
+    for field, parts in header.items():
+        views = [buffer[start + offset:start + offset + length].cast(kind)
+                 for kind, offset, length in parts]
+        if field == '_index':
+            columns[field] = _CodeIndex.from_buffer(views[0])
+        elif len(views) == 4:
+            columns[field] = _NameColumn.from_views(views)
+        elif len(views) == 2:
+            columns[field] = _StringColumn(views[1], views[0])
+        elif parts[0][0] == 'b':
+            columns[field] = _BoolColumn(views[0])
+        else:
+            columns[field] = views[0]
+    return columns
+
+
+class _LRUCache(object):
+    """Thread-safe dictionary keeping only the most recently used items"""
+    def __init__(self, maxsize):
+        self._maxsize = maxsize
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._items:
+                self._misses += 1
+                return None
+            self._hits += 1
+            value = self._items.pop(key)
+            self._items[key] = value
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self._maxsize:
+                self._items.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self._hits, 'misses': self._misses,
+                    'size': len(self._items), 'maxsize': self._maxsize}
+
+
+def _digit_deletes(text, depth):
+    """All the strings obtained by removing up to ``depth`` characters"""
+    ret = set([text])
+    current = ret
+    for i in range(depth):
+        current = set(variant[:index] + variant[index + 1:]
+                      for variant in current for index in range(len(variant)))
+        ret |= current
+    return ret
+
+
+def _edit_distance(first, second):
+    """
+    Damerau-Levenshtein distance (optimal string alignment), counting
+    swaps of adjacent characters as a single edit
+
+    """
+    return _edit_distance_from(first)(second)
+
+
+def _edit_distance_from(first):
+    """
+    Return a function computing the distance of :func:`_edit_distance`
+    from ``first`` to its argument. The columns of the dynamic
+    programming table are kept as bit vectors (Hyyrö's bit-parallel
+    algorithm), so each character of the argument costs a few integer
+    operations.
+
+    """
+    length = len(first)
+    mask = (1 << length) - 1
+    high = 1 << length >> 1
+    positions = {}
+    for index, char in enumerate(first):
+        positions[char] = positions.get(char, 0) | (1 << index)
+
+    def distance(second):
+        if not length:
+            return len(second)
+        positive, negative, score = mask, 0, length
+        diagonal, previous = 0, 0
+        for char in second:
+            matches = positions.get(char, 0)
+            swaps = ((~diagonal & matches) << 1) & previous
+            carry = ((matches & positive) + positive) ^ positive
+            diagonal = (carry | matches | negative | swaps) & mask
+            up = (negative | ~(diagonal | positive)) & mask
+            down = diagonal & positive
+            if up & high:
+                score += 1
+            elif down & high:
+                score -= 1
+            up = (up << 1) | 1
+            positive = ((down << 1) | ~(diagonal | up)) & mask
+            negative = diagonal & up & mask
+            previous = matches
+        return score
+    return distance
+
+
+"""
+------------
+Result sets
+------------
+"""
+
+
+class SirutaSet(object):
+    """
+    Set of SIRUTA codes stored as a dense bitmap over the code space.
+    Intersections (``&``), unions (``|``), differences (``-``) and
+    counting work on the whole bitmap at once. Iteration yields the
+    codes in ascending order.
+
+    :param codes: the initial codes
+    :type codes: iterable
+
+    """
+    __slots__ = ('_bits',)
+
+    def __init__(self, codes=()):
+        codes = list(codes)
+        if not codes:
+            self._bits = 0
+            return
+        bitmap = bytearray(max(codes) // 8 + 1)
+        for code in codes:
+            bitmap[code >> 3] |= 1 << (code & 7)
+        self._bits = int.from_bytes(bytes(bitmap), 'little')
+
+    @classmethod
+    def _from_bits(cls, bits):
+        ret = cls.__new__(cls)
+        ret._bits = bits
+        return ret
+
+    def __and__(self, other):
+        return SirutaSet._from_bits(self._bits & other._bits)
+
+    def __or__(self, other):
+        return SirutaSet._from_bits(self._bits | other._bits)
+
+    def __sub__(self, other):
+        return SirutaSet._from_bits(self._bits & ~other._bits)
+
+    def __xor__(self, other):
+        return SirutaSet._from_bits(self._bits ^ other._bits)
+
+    def __eq__(self, other):
+        return isinstance(other, SirutaSet) and self._bits == other._bits
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._bits)
+
+    def __bool__(self):
+        return self._bits != 0
+
+    __nonzero__ = __bool__
+
+    def __len__(self):
+        if hasattr(self._bits, 'bit_count'):
+            return self._bits.bit_count()
+        return bin(self._bits).count('1')
+
+    def __contains__(self, code):
+        return code >= 0 and (self._bits >> code) & 1 == 1
+
+    def __iter__(self):
+        words = (self._bits.bit_length() + 63) // 64
+        words = array.array('Q', self._bits.to_bytes(words * 8, 'little'))
+        if sys.byteorder != 'little':
+            words.byteswap()
+        for index, word in enumerate(words):
+            base = index * 64
+            while word:
+                low = word & -word
+                yield base + low.bit_length() - 1
+                word ^= low
+
+    def __repr__(self):
+        return "SirutaSet(%r)" % list(self)
+
+    def to_list(self):
+        """Return the codes as a sorted list"""
+        return list(self)
+
+
+"""
+---------
+Entities
+---------
+"""
+
+
+class SirutaEntity(object):
+    """
+    Read-only record for one entity, returned by
+    :meth:`SirutaDatabase.get_entity`. The numeric fields are read from
+    the database row; the names and descriptions are only formatted when
+    accessed, using the diacritics settings of the database.
+
+    On a columnar database, the record only holds the store and the
+    index of the entity in the columns, and each field is read from its
+    column when accessed.
+
+    """
+    __slots__ = ('_db', '_row', '_index')
+
+    def __init__(self, db, row, index=None):
+        object.__setattr__(self, '_db', db)
+        object.__setattr__(self, '_row', row)
+        object.__setattr__(self, '_index', index)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("SirutaEntity objects are read-only")
+
+    def _get(self, field):
+        if self._index is None:
+            return self._row[field]
+        return self._row.value(field, self._index)
+
+    def __eq__(self, other):
+        return isinstance(other, SirutaEntity) and \
+            all(self._get(field) == other._get(field)
+                for field in SirutaDatabase._fields)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._get('siruta'))
+
+    def __repr__(self):
+        return "SirutaEntity(%d, %r)" % (self._get('siruta'), self._get('name'))
+
+    siruta = property(lambda self: self._get('siruta'),
+                      doc="The SIRUTA code")
+    sup_code = property(lambda self: self._get('sirutasup'),
+                        doc="The code of the superior entity")
+    postal_code = property(lambda self: self._get('postcode'),
+                           doc="The postal code, ``0`` for several postal codes")
+    type = property(lambda self: self._get('type'), doc="The type code")
+    level = property(lambda self: self._get('level'), doc="The level")
+    urban = property(lambda self: self._get('urban'),
+                     doc="``True`` for urban entities")
+    county = property(lambda self: self._get('county'), doc="The county code")
+    region = property(lambda self: self._get('region'), doc="The region code")
+
+    @property
+    def name(self):
+        """The name, with the entity type prefix"""
+        return self._db._format_name(self._get('name'))
+
+    @property
+    def short_name(self):
+        """The name without the entity type prefix"""
+        return self._db._format_name(self._get('name'), prefix=False)
+
+    @property
+    def type_string(self):
+        """The description of the entity type"""
+        return self._db._format_type(self._get('type'))
+
+    @property
+    def county_name(self):
+        """The name of the county"""
+        return self._db._format_county(self._get('county'))
+
+    @property
+    def region_name(self):
+        """The name of the region"""
+        return self._db._regions.get(self._get('region'))
+
+
 """
 ----------------
 Siruta Database
@@ -70,13 +836,31 @@ class SirutaDatabase:
     The main class, representing the SIRUTA database.
 
     It reads data from a CSV file. The expected input format is:
-    SIRUTA;DENLOC;CODP;JUD;SIRSUP;TIP;NIV;MED;REGIUNE;FSJ;FS2;FS3;FSL;rang;fictiv
+    SIRUTA;DENLOC;CODP;JUD;SIRSUP;TIP;NIV;MED;REGIUNE;FSJ;FSL;NUTS
 
     Documentation for these fields can be found on the INSSE website.
+    If the file starts with a header row, the columns are looked up by
+    name, so other extract layouts (e.g. the one with
+    SIRUTA;DENLOC;CODP;JUD;SIRSUP;TIP;NIV;MED;REGIUNE;FSJ;FS2;FS3;FSL;rang;fictiv)
+    are read as well. Columns that are not used are ignored.
+
+    Files with the ``.arrow`` or ``.feather`` extension are instead
+    memory-mapped as Arrow IPC files, as written by :meth:`to_arrow`.
+    This requires the ``pyarrow`` module.
 
     :param filename: the CSV file containing the data. This is either \
     an abosulte path or a path relative to the current folder
     :param enforce_warnings: treat warnings as exceptions
+    :param counties: only load the entities from these counties; the \
+    county entries themselves are always loaded
+    :type counties: list
+    :param regions: only load the entities from these regions; the \
+    county entries themselves are always loaded
+    :type regions: list
+    :param fields: only load these fields of each entity, e.g. \
+    ``['siruta', 'name', 'sirutasup']``; the SIRUTA code is always \
+    loaded. The getters for the other fields return ``None``.
+    :type fields: list
 
     """
     _DIA_NEUTRAL = 0x0
@@ -86,22 +870,96 @@ class SirutaDatabase:
     _DIA_COMMA   = 0x8
     _DIA_NONE    = 0x10
 
-    def __init__(self, filename="siruta.csv", enforce_warnings=False):
-        if os.path.isabs(filename):
-            self._file = filename
+    # types of the entities that are the seat of their superior entity
+    _seat_types = (1, 5, 9, 17, 22)
+
+    # the levels allowed for each type
+    _type_levels = {
+        1: ('2',), 2: ('2',), 3: ('2',), 4: ('2',), 5: ('2',),
+        6: ('3',), 9: ('2', '3'), 10: ('3',), 11: ('3',),
+        17: ('3',), 18: ('3',), 19: ('3',), 22: ('3',), 23: ('3',),
+        40: ('1',),
+    }
+    # the types allowed for the superior entity of each type
+    _parent_types = {
+        1: (40,), 2: (40,), 3: (40,), 4: (40,), 5: (40,),
+        6: (9,), 9: (1, 4, 40), 10: (1, 4), 11: (1, 4),
+        17: (2, 5), 18: (2, 5), 19: (2, 5), 22: (3,), 23: (3,),
+    }
+
+    _fields = ['siruta', 'name', 'postcode', 'county', 'sirutasup',
+               'type', 'level', 'urban', 'region']
+
+    # the header names of the columns in the INSSE extracts
+    _header_fields = {
+        'SIRUTA':  'siruta',
+        'DENLOC':  'name',
+        'CODP':    'postcode',
+        'JUD':     'county',
+        'SIRSUP':  'sirutasup',
+        'TIP':     'type',
+        'NIV':     'level',
+        'MED':     'urban',
+        'REGIUNE': 'region',
+    }
+    # the column positions and count of files without a header row
+    _default_layout = (dict(zip(_fields, range(len(_fields)))), 12)
+
+    def __init__(self, filename="siruta.csv", enforce_warnings=False,
+                 counties=None, regions=None, fields=None):
+        self._file = self._find_file(filename)
+        if self._file is None:
+            self.__notify_error("CSV file not found. Please set the "
+                                "filename parameter to a valid path "
+                                "relative to the current folder",
+                                enforce=True)
+        self.__init_tables(enforce_warnings, counties, regions, fields)
+        self.__load()
+
+    def __load(self):
+        if os.path.splitext(self._file)[1] in (".arrow", ".feather"):
+            self.__load_arrow()
         else:
-            fname = os.path.join(
-                os.path.dirname(os.path.abspath(__file__)),
-                filename)
-            if os.path.isfile(fname):  # search in the directory running the lib
-                self._file = fname
-            elif os.path.isfile(filename):  # search in the current directory
-                self._file = filename
-            else:
-                self.__notify_error("CSV file not found. Please set the "
-                                    "filename parameter to a valid path "
-                                    "relative to the current folder",
-                                    enforce=True)
+            self.__parse_file()
+        self.__build_county_list()
+
+    def reload(self):
+        """
+        Read the data file again, e.g. after it was replaced with a newer
+        extract. All the indexes and cached query results are dropped.
+
+        """
+        if self._file is None:
+            self.__notify_error("This database was not loaded from a file")
+            return
+        self._data = collections.OrderedDict({})
+        self._counties = {}
+        self._indexes = {}
+        self._query_cache = None
+        self._rejected_rows = []
+        self.__load()
+
+    @staticmethod
+    def _find_file(filename):
+        """
+        Look for the data file in the directory of the library, then in
+        the current directory. Absolute paths are returned unchanged.
+
+        :return: the path of the file or ``None`` if it was not found
+
+        """
+        if os.path.isabs(filename):
+            return filename
+        fname = os.path.join(
+            os.path.dirname(os.path.abspath(__file__)),
+            filename)
+        if os.path.isfile(fname):  # search in the directory running the lib
+            return fname
+        elif os.path.isfile(filename):  # search in the current directory
+            return filename
+        return None
+
+    def __init_tables(self, enforce_warnings, counties, regions, fields=None):
         self._data = collections.OrderedDict({})
         self._names = {}
         self._counties = {}
@@ -136,9 +994,41 @@ class SirutaDatabase:
         self._dia_trans = {ord(u"Ş"): u"Ș", ord(u"ş"): u"ș", ord(u"Ţ"): u"Ț", ord(u"ţ"): u"ț"}
         self._enforce_warnings = enforce_warnings
         self._last_error = ""
+        if counties is not None and type(counties) is not list:
+            self.__notify_error("Invalid county list required", enforce=True)
+        if regions is not None and type(regions) is not list:
+            self.__notify_error("Invalid region list required", enforce=True)
+        self._rejected_rows = []
+        self._county_filter = None if counties is None else set(counties)
+        self._region_filter = None if regions is None else set(regions)
+        if fields is not None and \
+           not (type(fields) is list and set(fields) <= set(self._fields)):
+            self.__notify_error("Invalid field list required", enforce=True)
+        self._loaded_fields = list(self._fields) if fields is None else \
+            [field for field in self._fields if field == 'siruta' or field in fields]
+        self._all_fields_loaded = self._loaded_fields == self._fields
         self._dia = self._DIA_NEUTRAL
-        self.__parse_file()
-        self.__build_county_list()
+        self._indexes = {}
+        self._query_cache_size = 0
+        self._query_cache = None
+
+    @classmethod
+    def _from_data(cls, data, enforce_warnings=False):
+        """
+        Build a database around an existing ``_data`` mapping, without
+        reading any file.
+
+        """
+        db = cls.__new__(cls)
+        db.__init_tables(enforce_warnings, None, None)
+        db._file = None
+        db._data = data
+        if isinstance(data, _ColumnarRows):
+            db._loaded_fields = [field for field in cls._fields
+                                 if field in data._columns]
+            db._all_fields_loaded = db._loaded_fields == cls._fields
+        db.__build_county_list()
+        return db
 
     def __notify_error(self, message, enforce=False):
         if enforce or self._enforce_warnings:
@@ -153,42 +1043,204 @@ class SirutaDatabase:
         """
         Parse a csv file extracted from the official mdb database.
 
-        The output format is: TODO
+        The file is read in one go and, unless it contains quoted
+        fields, split on line ends and semicolons without going through
+        the csv module. The rows are checked one by one, but the columns
+        are only converted once all the rows are checked, and only for
+        the fields that are loaded.
+
+        """
+        with open(self._file, 'r') as csvfile:
+            content = csvfile.read()
+        if PY2 or '"' in content:
+            rows = csv.reader(io.StringIO(content), delimiter=';')
+            translate = True
+        else:
+            rows = self.__split_rows(content)
+            translate = False
+        selected, positions = self.__select_rows(rows)
+        if selected:
+            self.__store_columns(selected, positions, translate)
+
+    def __split_rows(self, content):
+        """Split a file without quoted fields into rows, normalizing the \
+        diacritics of the whole file at once"""
+        for old, new in self._dia_trans.items():
+            content = content.replace(unichr(old), new)
+        return (line.split(';') for line in content.splitlines() if line)
+
+    def __select_rows(self, rows):
+        """
+        Check the rows and keep those of the selected counties and
+        regions, reading the layout from the header row if there is one.
+
+        :return: a tuple with the rows kept and the positions of the \
+        fields; no rows are kept if the header misses some columns
 
         """
+        positions, length = self._default_layout
+        is_valid = self.siruta_is_valid
+        selected = []
+        for row in rows:
+            try:
+                siruta = int(row[0])
+            except ValueError:
+                if not selected and self.__is_header(row):
+                    layout = self.__read_layout(row)
+                    if layout is None:
+                        return [], positions
+                    positions, length = layout
+                    continue
+                self._rejected_rows.append("Line %s has an invalid SIRUTA code" % str(row))
+                self.__notify_error(self._rejected_rows[-1])
+                continue
+            if len(row) == length and not self.__row_is_selected(row, positions):
+                continue
+            if not is_valid(siruta):
+                self.__notify_error("SIRUTA code %d is not valid" % siruta)
+            if len(row) != length:
+                self._rejected_rows.append("Line %s does not have %d elements" %
+                                           (str(row), length))
+                self.__notify_error(self._rejected_rows[-1])
+                continue
+            selected.append(row)
+        return selected, positions
 
+    def __store_columns(self, selected, positions, translate):
+        """Convert the columns of the loaded fields and store the rows"""
         if PY2:
             text = lambda v: v.decode('utf-8')
         else:
             text = lambda v: v
-        with open(self._file, 'r') as csvfile:
-            reader = csv.reader(csvfile, delimiter=';')
-            for row in reader:
-                try:
-                    siruta = int(row[0])
-                except ValueError:
-                    self.__notify_error("Line %s has an invalid SIRUTA code" % str(row))
-                    continue
-                if not self.siruta_is_valid(siruta):
-                    self.__notify_error("SIRUTA code %d is not valid" % siruta)
-                if len(row) != 12:
-                    self.__notify_error("Line %s does not have 15 elements" % str(row))
+
+        def names(column):
+            column = [text(name) for name in column]
+            if translate:
+                column = [name.translate(self._dia_trans) for name in column]
+            return column
+        converters = {
+            'name':  names,
+            'level': lambda column: [text(level) for level in column],
+            'urban': lambda column: [urban == "1" for urban in column],
+        }
+        columns = list(zip(*selected))
+        fields = self._loaded_fields
+        values = zip(*[converters.get(field, lambda column: map(int, column))(
+            columns[positions[field]]) for field in fields])
+        data = self._data
+        if fields != self._fields:
+            for entry in values:
+                data[entry[0]] = dict(zip(fields, entry))
+        else:
+            self.__store_rows(values)
+        if len(data) < len(selected):
+            counts = collections.Counter(columns[positions['siruta']])
+            self._rejected_rows.extend(
+                "SIRUTA code %s appears more than once" % code
+                for code, count in counts.items() if count > 1)
+
+    def __store_rows(self, values):
+        """Store the converted rows, one dictionary per entity"""
+        data = self._data
+        for siruta, name, postcode, county, sirutasup, type_, level, urban, \
+                region in values:
+            data[siruta] = {
+                'siruta':    siruta,
+                'name':      name,
+                'postcode':  postcode,
+                'county':    county,
+                'sirutasup': sirutasup,
+                'type':      type_,
+                'level':     level,
+                'urban':     urban,
+                'region':    region,
+            }
+
+    @staticmethod
+    def __column_name(column):
+        """Normalize the name of a column in a header row"""
+        if PY2:
+            column = column.decode('utf-8')
+        return column.lstrip(u'\ufeff').strip().upper()
+
+    def __is_header(self, row):
+        """Check if a row is the header row of an extract"""
+        return self.__column_name(row[0]) == u'SIRUTA'
+
+    def __read_layout(self, header):
+        """
+        Map the fields to the column positions given by a header row.
+
+        :return: a tuple with the positions of the fields and the \
+        number of columns, or ``None`` if some of the needed columns \
+        are missing
+
+        """
+        positions = {}
+        for position, column in enumerate(header):
+            field = self._header_fields.get(self.__column_name(column))
+            if field is not None and field not in positions:
+                positions[field] = position
+        needed = set(self._loaded_fields)
+        if self._county_filter is not None or self._region_filter is not None:
+            needed.add('type')
+        if self._county_filter is not None:
+            needed.add('county')
+        if self._region_filter is not None:
+            needed.add('region')
+        missing = [field for field in self._fields
+                   if field in needed and field not in positions]
+        if missing:
+            self.__notify_error("The header does not contain the columns "
+                                "for the fields %s" % ", ".join(missing))
+            return None
+        return positions, len(header)
+
+    def __load_arrow(self):
+        """
+        Memory-map an Arrow IPC file written by ``to_arrow``. The
+        columns are not copied; the getters decode the values they need
+        on access.
+
+        """
+        pa = _require("pyarrow")
+        pc = _require("pyarrow.compute")
+        with pa.memory_map(self._file, 'r') as source:
+            table = pa.ipc.open_file(source).read_all()
+        if self._county_filter is not None or self._region_filter is not None:
+            selected = None
+            for field, values in (('county', self._county_filter),
+                                  ('region', self._region_filter)):
+                if values is None:
                     continue
-                if row[7] == "1":
-                    urban = True
-                else:
-                    urban = False
-                self._data[siruta] = {
-                    'siruta':    siruta,
-                    'name':      text(row[1]).translate(self._dia_trans),
-                    'postcode':  int(row[2]),
-                    'county':    int(row[3]),
-                    'sirutasup': int(row[4]),
-                    'type':      int(row[5]),
-                    'level':     text(row[6]),
-                    'urban':     urban,
-                    'region':    int(row[8]),
-                }
+                match = pc.is_in(table.column(field),
+                                 value_set=pa.array(sorted(values), pa.int8()))
+                selected = match if selected is None else pc.and_(selected, match)
+            table = table.filter(pc.or_(pc.equal(table.column('type'), 40), selected))
+        columns = dict((field, table.column(field))
+                       for field in self._loaded_fields)
+        self._data = _ColumnarRows(columns,
+                                   value=lambda column, index: column[index].as_py(),
+                                   to_list=lambda column: column.to_pylist())
+
+    def __row_is_selected(self, row, positions):
+        """
+        Check a raw CSV row against the county and region filters
+        given to the constructor. County entries are always selected,
+        since the county names are needed by the other entities.
+
+        """
+        if self._county_filter is None and self._region_filter is None:
+            return True
+        if int(row[positions['type']]) == 40:
+            return True
+        if self._county_filter is not None and \
+           int(row[positions['county']]) not in self._county_filter:
+            return False
+        if self._region_filter is not None and \
+           int(row[positions['region']]) not in self._region_filter:
+            return False
+        return True
 
     def __build_county_list(self):
         """
@@ -197,42 +1249,489 @@ class SirutaDatabase:
         Parse the whole siruta table for entries with type == 40
 
         """
+        if any(field not in self._loaded_fields
+               for field in ('name', 'county', 'type')):
+            return
+        if isinstance(self._data, _ColumnarRows):
+            for code in self._data.find('type', 40):
+                entry = self._data[code]
+                self._counties[entry['county']] = entry['name']
+            return
         for entry in self._data.values():
             if entry['type'] == 40:
                 self._counties[entry['county']] = entry['name']
 
-    def get_siruta_list(self, county_list=None, type_list=None, name=None, add_prefix=False):
+    def _view(self, data=None):
         """
-        Get a list of SIRUTA codes for entities matching the limitations
-        imposed by both the ``county`` and ``type`` parameters
+        Return a shallow copy of the database that shares all the tables
+        and indexes with this one, but has its own query cache. If
+        ``data`` is given, the copy uses it instead of ``_data`` and
+        rebuilds its county list.
 
-        :param county_list: List of counties for which we want the codes
-        :type county_list: list
-        :param type_list: List of types for which we want the codes
-        :type type_list: list
-        :param name: The name of the entity to get
-        :type name: string
-        :param add_prefix: Also check for match with name prefixes
-        :type add_prefix: bool
+        """
+        view = copy.copy(self)
+        view._query_cache = None
+        if data is not None:
+            view._data = data
+            view._indexes = {}
+            view._counties = {}
+            view.__build_county_list()
+        return view
+
+    def compact(self):
+        """
+        Convert the database to a compact in-memory representation: the
+        numeric fields are stored in arrays and the names in a
+        front-coded dictionary, instead of one dictionary per entity.
+        This uses much less memory, at the price of slightly slower
+        getters. The indexes are rebuilt on demand.
+
+        """
+        if isinstance(self._data, _ColumnarRows) or \
+           not self._has_fields(self._fields):
+            return
+        columns = self._columns()
+        compacted = {
+            'siruta':    array.array('i', columns['siruta']),
+            'name':      _NameColumn(columns['name'], self._prefixes),
+            'postcode':  array.array('i', columns['postcode']),
+            'county':    array.array('b', columns['county']),
+            'sirutasup': array.array('i', columns['sirutasup']),
+            'type':      array.array('b', columns['type']),
+            'level':     _CategoryColumn(columns['level']),
+            'urban':     _BoolColumn(array.array('b', columns['urban'])),
+            'region':    array.array('b', columns['region']),
+        }
+        self._data = _ColumnarRows(compacted)
+        self._indexes = {}
+        self._query_cache = None
+
+    def _has_fields(self, fields):
+        """
+        Check that the given fields were loaded, see the ``fields``
+        parameter of the constructor. A warning is issued for the first
+        missing field.
+
+        """
+        if self._all_fields_loaded:
+            return True
+        for field in fields:
+            if field not in self._loaded_fields:
+                self.__notify_error("The %s field was not loaded" % field)
+                return False
+        return True
+
+    def _columns(self):
+        """
+        Return the database as a dictionary of field name to a list of
+        values, in file order.
+
+        """
+        if isinstance(self._data, _ColumnarRows):
+            return self._data.columns()
+        columns = dict((field, []) for field in self._loaded_fields)
+        for entry in self._data.values():
+            for field in self._loaded_fields:
+                columns[field].append(entry[field])
+        return columns
+
+    def to_arrow(self, filename=None):
+        """
+        Export the database as a ``pyarrow.Table``. Names, levels and the
+        county and region labels are dictionary-encoded. Names are
+        exported as they appear in the file, regardless of the
+        diacritics settings.
+
+        :param filename: if given, the table is also written to this \
+        file in the Arrow IPC file format, which can be memory-mapped \
+        by passing it back to :class:`SirutaDatabase`
+        :type filename: string
+
+        :return: a table with one row per entity
+        :rtype: pyarrow.Table
+
+        """
+        pa = _require("pyarrow")
+        if not self._has_fields(self._fields):
+            return None
+        columns = self._columns()
+        county_names = [self._counties.get(county) for county in columns['county']]
+        region_names = [self._regions.get(region) for region in columns['region']]
+        table = pa.table([
+            pa.array(columns['siruta'], pa.int32()),
+            pa.array(columns['name'], pa.string()).dictionary_encode(),
+            pa.array(columns['postcode'], pa.int32()),
+            pa.array(columns['county'], pa.int8()),
+            pa.array(columns['sirutasup'], pa.int32()),
+            pa.array(columns['type'], pa.int8()),
+            pa.array(columns['level'], pa.string()).dictionary_encode(),
+            pa.array(columns['urban'], pa.bool_()),
+            pa.array(columns['region'], pa.int8()),
+            pa.array(county_names, pa.string()).dictionary_encode(),
+            pa.array(region_names, pa.string()).dictionary_encode(),
+        ], names=self._fields + ['county_name', 'region_name'])
+        if filename is not None:
+            with pa.OSFile(filename, 'wb') as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+        return table
+
+    def to_parquet(self, filename):
+        """
+        Write the database to a Parquet file, using the same schema as
+        :meth:`to_arrow`
+
+        :param filename: the output file
+        :type filename: string
+
+        """
+        pq = _require("pyarrow.parquet")
+        table = self.to_arrow()
+        if table is None:
+            return
+        pq.write_table(table, filename)
+
+    def _lookup_columns(self, fields, prefix=True, diacritics=None):
+        """
+        Compute the requested fields for every entity in the database,
+        with the same results as the corresponding getters.
+
+        :param fields: names of the getters without the ``get_`` prefix, \
+        e.g. ``name``, ``sup_name`` or ``county_string``
+        :param prefix: passed to the name getters
+        :param diacritics: keyword arguments for \
+        :meth:`set_diacritics_params` to use instead of the current \
+        settings
+
+        :return: a list of codes and a dictionary of field name to the \
+        list of values for those codes, or ``None`` for invalid fields
+
+        """
+        db = self.__diacritics_view(diacritics)
+        getters = db.__field_getters(prefix)
+        for field in fields:
+            if field not in getters:
+                self.__notify_error("Invalid field %s required" % field)
+                return None
+        codes = list(self._data)
+        table = dict((field, [getters[field](code) for code in codes])
+                     for field in fields)
+        return codes, table
+
+    def __diacritics_view(self, diacritics):
+        """
+        Return this database or, if ``diacritics`` are given, a view
+        using them as the diacritics settings
+
+        """
+        if diacritics is None:
+            return self
+        db = self._view()
+        db.set_diacritics_params(**diacritics)
+        return db
+
+    def __field_getters(self, prefix):
+        """
+        Map the field names accepted by the export and enrichment
+        functions to the corresponding getters
+
+        """
+        return {
+            'name': lambda code: self.get_name(code, prefix),
+            'sup_code': self.get_sup_code,
+            'sup_name': lambda code: self.get_name(
+                self.get_sup_code(code), prefix)
+            if self.get_sup_code(code) in self._data else None,
+            'postal_code': self.get_postal_code,
+            'type': self.get_type,
+            'type_string': self.get_type_string,
+            'county': self.get_county,
+            'county_string': lambda code: self.get_county_string(code, prefix),
+            'county_name': lambda code: self.get_county_string(code, prefix),
+            'region': self.get_region,
+            'region_string': self.get_region_string,
+            'region_name': self.get_region_string,
+        }
+
+    def __children_index(self):
+        """Build on first use a dictionary of code to inferior codes"""
+        if 'children' not in self._indexes:
+            children = collections.defaultdict(list)
+            for code in self._data:
+                children[self._data[code]['sirutasup']].append(code)
+            self._indexes['children'] = dict(children)
+        return self._indexes['children']
+
+    def __export_records(self, fields, prefix, diacritics):
+        """
+        Return a function building the dictionary exported for a code,
+        or ``None`` for invalid fields
+
+        """
+        if fields is None:
+            fields = self._export_fields
+        db = self.__diacritics_view(diacritics)
+        getters = db.__field_getters(prefix)
+        for field in fields:
+            if field not in getters:
+                self.__notify_error("Invalid field %s required" % field)
+                return None
+        getters = [(field, getters[field]) for field in fields]
+        return lambda code: collections.OrderedDict(
+            [('siruta', code)] + [(field, getter(code)) for field, getter in getters])
+
+    def iter_ndjson(self, fields=None, prefix=True, diacritics=None,
+                    encoding=None):
+        """
+        Export the database as newline-delimited JSON, one entity per
+        line, walking the hierarchy depth-first from the counties. The
+        lines are generated one by one.
+
+        :param fields: the fields to export besides ``siruta``, named \
+        like the getters without the ``get_`` prefix
+        :type fields: list
+        :param prefix: True if names should include the entity type
+        :type prefix: bool
+        :param diacritics: keyword arguments for \
+        :meth:`set_diacritics_params`, the current settings are used \
+        otherwise
+        :type diacritics: dict
+        :param encoding: if given, the lines are encoded to bytes
+        :type encoding: string
+
+        :return: a generator of lines
+        :rtype: generator
+
+        """
+        record = self.__export_records(fields, prefix, diacritics)
+        if record is None or not self._has_fields(['sirutasup']):
+            return
+        for code in self.__walk_hierarchy():
+            line = json.dumps(record(code), ensure_ascii=False) + "\n"
+            yield line.encode(encoding) if encoding else line
+
+    def iter_json_tree(self, fields=None, prefix=True, diacritics=None,
+                       encoding=None):
+        """
+        Export the hierarchy as a nested JSON array: the counties, each
+        with the ``children`` UATs, each with their localities. The
+        document is generated in small chunks while walking the
+        hierarchy once.
+
+        The parameters are the same as for :meth:`iter_ndjson`.
+
+        :return: a generator of chunks of the JSON document
+        :rtype: generator
+
+        """
+        record = self.__export_records(fields, prefix, diacritics)
+        if record is None or not self._has_fields(['sirutasup']):
+            return
+        encode = (lambda chunk: chunk.encode(encoding)) if encoding else \
+            (lambda chunk: chunk)
+        children = self.__children_index()
+        yield encode("[")
+        stack = [iter(self.__roots())]
+        first = True
+        while stack:
+            code = next(stack[-1], None)
+            if code is None:
+                stack.pop()
+                yield encode("]}" if stack else "]")
+                first = False
+                continue
+            chunk = json.dumps(record(code), ensure_ascii=False)
+            if not first:
+                chunk = "," + chunk
+            if code in children:
+                chunk = chunk[:-1] + ', "children": ['
+                stack.append(iter(children[code]))
+                first = True
+            else:
+                first = False
+            yield encode(chunk)
+
+    def write_ndjson(self, fp, **kwargs):
+        """
+        Write :meth:`iter_ndjson` to a file-like object, e.g. an open
+        file or ``socket.makefile("w")``
+
+        :param fp: an object with a ``write`` method
+        :param kwargs: the parameters of :meth:`iter_ndjson`
+
+        """
+        for chunk in self.iter_ndjson(**kwargs):
+            fp.write(chunk)
+
+    def write_json_tree(self, fp, **kwargs):
+        """
+        Write :meth:`iter_json_tree` to a file-like object, e.g. an
+        open file or ``socket.makefile("w")``
+
+        :param fp: an object with a ``write`` method
+        :param kwargs: the parameters of :meth:`iter_json_tree`
+
+        """
+        for chunk in self.iter_json_tree(**kwargs):
+            fp.write(chunk)
+
+    def __roots(self):
+        """The entities whose superior entity is not in the database"""
+        def is_root(code):
+            sup = self._data[code]['sirutasup']
+            return sup == code or sup not in self._data
+        return [code for code in self._data if is_root(code)]
+
+    def __walk_hierarchy(self):
+        """Yield all the codes reachable from the roots, depth-first"""
+        children = self.__children_index()
+        stack = list(reversed(self.__roots()))
+        while stack:
+            code = stack.pop()
+            yield code
+            stack.extend(reversed(children.get(code, [])))
+
+    def __bitmap_index(self):
+        """
+        Build on first use one :class:`SirutaSet` for every county, type,
+        region and urban status
+
+        """
+        if 'bitmap' not in self._indexes:
+            columns = self._columns()
+            index = {}
+            for field in ('county', 'type', 'region', 'urban'):
+                if field not in columns:
+                    continue
+                groups = collections.defaultdict(list)
+                for code, value in zip(columns['siruta'], columns[field]):
+                    groups[value].append(code)
+                index[field] = dict((value, SirutaSet(codes))
+                                    for value, codes in groups.items())
+            index['all'] = SirutaSet(columns['siruta'])
+            self._indexes['bitmap'] = index
+        return self._indexes['bitmap']
+
+    def get_siruta_set(self, county_list=None, type_list=None,
+                       region_list=None, urban=None):
+        """
+        Get the set of SIRUTA codes for entities matching all the given
+        limitations. The result is computed from precomputed bitmaps and
+        can be combined with other sets using ``&``, ``|`` and ``-``.
+
+        :param county_list: List of counties for which we want the codes
+        :type county_list: list
+        :param type_list: List of types for which we want the codes
+        :type type_list: list
+        :param region_list: List of regions for which we want the codes
+        :type region_list: list
+        :param urban: ``True`` for urban entities only, ``False`` for \
+        rural entities only
+        :type urban: bool
+
+        :return: the matching codes
+        :rtype: SirutaSet
+
+        """
+        fields = [field for field, values in (('county', county_list),
+                                              ('type', type_list),
+                                              ('region', region_list),
+                                              ('urban', urban))
+                  if values is not None]
+        if not self._has_fields(fields):
+            return SirutaSet()
+        index = self.__bitmap_index()
+        ret = index['all']
+        for field, values in (('county', county_list), ('type', type_list),
+                              ('region', region_list)):
+            if values is None:
+                continue
+            if type(values) is not list:
+                self.__notify_error("Invalid %s required" % field)
+                return SirutaSet()
+            selected = SirutaSet()
+            for value in values:
+                if value in index[field]:
+                    selected = selected | index[field][value]
+            ret = ret & selected
+        if urban is not None:
+            ret = ret & index['urban'].get(bool(urban), SirutaSet())
+        return ret
+
+    def get_siruta_list(self, county_list=None, type_list=None, name=None, add_prefix=False,
+                        as_set=False):
+        """
+        Get a list of SIRUTA codes for entities matching the limitations
+        imposed by both the ``county`` and ``type`` parameters
+
+        :param county_list: List of counties for which we want the codes
+        :type county_list: list
+        :param type_list: List of types for which we want the codes
+        :type type_list: list
+        :param name: The name of the entity to get
+        :type name: string
+        :param add_prefix: Also check for match with name prefixes
+        :type add_prefix: bool
+        :param as_set: Return a :class:`SirutaSet` instead of a list
+        :type as_set: bool
 
         :return: List of codes matching the limitations or an empty list
         :rtype: list
 
         """
-        ret = []
+        if as_set:
+            return SirutaSet(self.get_siruta_list(county_list, type_list,
+                                                  name, add_prefix))
+        if not self.__check_list_filters(county_list, type_list, name):
+            return []
+        if name is not None:
+            name = name.upper()
+
+        cache = self.__query_cache()
+        key = None
+        if cache is not None:
+            key = self.__list_cache_key(county_list, type_list, name, add_prefix)
+        if key is not None:
+            cached = cache.get(key)
+            if cached is not None:
+                return cached
+
+        ret = self.__filter_entities(county_list, type_list, name, add_prefix)
+        if key is not None:
+            ret = tuple(ret)
+            cache.put(key, ret)
+        return ret
+
+    def __check_list_filters(self, county_list, type_list, name):
+        """Check the filters of :meth:`get_siruta_list`"""
         if county_list is not None and type(county_list) is not list:
             self.__notify_error("Invalid county required")
-            return ret
+            return False
         if type_list is not None and type(type_list) is not list:
             self.__notify_error("Invalid type required")
-            return ret
+            return False
         if name is not None and type(name) is not str:
             self.__notify_error("Invalid name required")
-            return ret
+            return False
+        return self._has_fields([field for field, value in (('county', county_list),
+                                                            ('type', type_list),
+                                                            ('name', name))
+                                 if value is not None])
 
-        if name is not None:
-            name = name.upper()
+    @staticmethod
+    def __list_cache_key(county_list, type_list, name, add_prefix):
+        """The key of a query in the query cache, ``None`` if some of \
+        the values cannot be hashed"""
+        try:
+            return (None if county_list is None else frozenset(county_list),
+                    None if type_list is None else frozenset(type_list),
+                    name, bool(add_prefix))
+        except TypeError:
+            return None
 
+    def __filter_entities(self, county_list, type_list, name, add_prefix):
+        """Scan the database for :meth:`get_siruta_list`"""
+        ret = []
         for entry in self._data.values():
             if (county_list is None or entry['county'] in county_list) and\
                (type_list is None or entry['type'] in type_list):
@@ -242,9 +1741,500 @@ class SirutaDatabase:
                     idx = entry['name'].find(name)
                     if idx > 0 and entry['name'][:idx] in self._prefixes:
                         ret.append(entry['siruta'])
+        return ret
+
+    # the letters of the Romanian alphabet, in collation order
+    _collation = dict((ord(letter), unichr(0x100 + position)) for position, letter
+                      in enumerate(u"AĂÂBCDEFGHIÎJKLMNOPQRSȘTȚUVWXYZ"))
+
+    _page_orders = ('name', 'code', 'type')
+    # the fields needed to sort in each order
+    _page_order_fields = {'name': ['name'], 'code': [],
+                          'type': ['level', 'type', 'name']}
+    # the types of the elements of the sort keys in each order
+    _page_key_types = {'name': (str, int), 'code': (int,),
+                       'type': (str, int, str, int)}
+
+    def __sort_key(self, entry, order):
+        """
+        Get the key used to sort an entity in the given order. All the
+        keys end with the code, so no two entities have the same key.
+
+        """
+        if order == 'code':
+            return (entry['siruta'],)
+        name = entry['name']
+        for prefix in self._prefixes:
+            if name.startswith(prefix):
+                name = name[len(prefix):]
+        name = name.translate(self._collation)
+        if order == 'type':
+            return (entry['level'], entry['type'], name, entry['siruta'])
+        return (name, entry['siruta'])
+
+    def __page_segments(self, order):
+        """
+        Sort the database once in the given order and split it into
+        segments by county and type, keeping the order in each segment.
+
+        :return: a tuple with a dictionary of ``(county, type)`` to a \
+        tuple of the sorted keys and the codes, and the same tuple for \
+        the whole database
+
+        """
+        if ('pages', order) not in self._indexes:
+            entries = sorted((self.__sort_key(entry, order), entry['siruta'],
+                              entry['county'], entry['type'])
+                             for entry in self._data.values())
+            segments = {}
+            for key, code, county, type_ in entries:
+                keys, codes = segments.setdefault((county, type_), ([], []))
+                keys.append(key)
+                codes.append(code)
+            everything = ([entry[0] for entry in entries],
+                          [entry[1] for entry in entries])
+            self._indexes[('pages', order)] = (segments, everything)
+        return self._indexes[('pages', order)]
 
+    def get_siruta_page(self, county_list=None, type_list=None, order="name",
+                        limit=50, cursor=None):
+        """
+        Get one page of the codes of the entities from the given counties
+        and of the given types, in a stable order. The entities are
+        sorted once per order, as a whole and in segments by county and
+        type. Without filters, a page is a slice of the whole order;
+        with filters, the segments of the selected counties and types
+        are merged, so a page costs as much as its size plus one binary
+        search per segment.
+
+        :param county_list: List of counties for which we want the codes
+        :type county_list: list
+        :param type_list: List of types for which we want the codes
+        :type type_list: list
+        :param order: ``name`` to sort by the name without prefix, using \
+        the Romanian alphabet, ``code`` to sort by the SIRUTA code or \
+        ``type`` to sort by level, then type, then name
+        :type order: string
+        :param limit: the maximum number of codes to return
+        :type limit: int
+        :param cursor: the cursor returned with the previous page, or \
+        ``None`` for the first page
+        :type cursor: string
+
+        :return: a tuple with the codes on the page and the cursor of \
+        the next page (``None`` after the last page), or ``None`` if \
+        the parameters are invalid
+        :rtype: tuple
+
+        """
+        if not self.__check_page_arguments(county_list, type_list, order, limit):
+            return None
+        after = None
+        if cursor is not None:
+            after = self.__decode_cursor(cursor, order)
+            if after is None:
+                self.__notify_error("Invalid cursor required")
+                return None
+        segments, everything = self.__page_segments(order)
+        if county_list is None and type_list is None:
+            keys, codes = everything
+            start = 0 if after is None else bisect.bisect_right(keys, after)
+            page = list(zip(keys[start:start + limit + 1],
+                            codes[start:start + limit + 1]))
+        else:
+            page = list(itertools.islice(self.__merge_segments(
+                segments, county_list, type_list, after), limit + 1))
+        if len(page) <= limit:
+            return [code for key, code in page], None
+        page = page[:limit]
+        cursor = json.dumps([order, list(page[-1][0])])
+        cursor = base64.urlsafe_b64encode(cursor.encode('utf-8')).decode('ascii')
+        return [code for key, code in page], cursor
+
+    def __check_page_arguments(self, county_list, type_list, order, limit):
+        """Check the arguments of :meth:`get_siruta_page`"""
+        if county_list is not None and type(county_list) is not list:
+            self.__notify_error("Invalid county required")
+            return False
+        if type_list is not None and type(type_list) is not list:
+            self.__notify_error("Invalid type required")
+            return False
+        if order not in self._page_orders:
+            self.__notify_error("Invalid order required")
+            return False
+        if type(limit) is not int or limit <= 0:
+            self.__notify_error("Invalid limit required")
+            return False
+        return self._has_fields(['county', 'type'] + self._page_order_fields[order])
+
+    def __decode_cursor(self, cursor, order):
+        """
+        Decode a cursor returned by :meth:`get_siruta_page`
+
+        :return: the sort key of the last entity of the previous page, \
+        or ``None`` if the cursor is invalid or was built for another \
+        order
+
+        """
+        try:
+            cursor_order, after = json.loads(
+                base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        except (ValueError, TypeError, UnicodeError, AttributeError):
+            return None
+        kinds = self._page_key_types[order]
+        if cursor_order != order or type(after) is not list or \
+           len(after) != len(kinds) or \
+           any(type(value) is not kind for value, kind in zip(after, kinds)):
+            return None
+        return tuple(after)
+
+    @staticmethod
+    def __merge_segments(segments, county_list, type_list, after):
+        """Merge the segments of the selected counties and types, \
+        starting after the given sort key"""
+        def segment(keys, codes, start):
+            for index in range(start, len(keys)):
+                yield keys[index], codes[index]
+
+        streams = []
+        for (county, type_), (keys, codes) in segments.items():
+            if (county_list is not None and county not in county_list) or \
+               (type_list is not None and type_ not in type_list):
+                continue
+            start = 0 if after is None else bisect.bisect_right(keys, after)
+            streams.append(segment(keys, codes, start))
+        return heapq.merge(*streams)
+
+    def __query_cache(self):
+        if not self._query_cache_size:
+            return None
+        if self._query_cache is None:
+            self._query_cache = _LRUCache(self._query_cache_size)
+        return self._query_cache
+
+    def set_query_cache(self, maxsize=256):
+        """
+        Enable or disable caching of :meth:`get_siruta_list` results.
+        While the cache is enabled the results are returned as tuples,
+        so they can be shared safely between callers. The cache is
+        dropped when the data is reloaded.
+
+        :param maxsize: the number of results to keep, the least recently \
+        used ones being evicted first; ``0`` disables the cache
+        :type maxsize: int
+
+        """
+        self._query_cache_size = maxsize
+        self._query_cache = None
+
+    def get_query_cache_stats(self):
+        """
+        Get statistics about the :meth:`get_siruta_list` result cache
+
+        :return: a dictionary with the ``hits``, ``misses``, current \
+        ``size`` and ``maxsize`` of the cache
+        :rtype: dict
+
+        """
+        cache = self.__query_cache()
+        if cache is None:
+            return {'hits': 0, 'misses': 0, 'size': 0, 'maxsize': 0}
+        return cache.stats()
+
+    _group_fields = ('county', 'type', 'region', 'urban')
+
+    _export_fields = ['name', 'sup_code', 'type', 'postal_code']
+
+    # abbreviations used in labels instead of the name prefixes, or for
+    # the entity types whose names are not prefixed
+    _label_prefixes = {u"JUDEȚUL ": u"jud.", u"MUNICIPIUL ": u"mun.",
+                       u"ORAȘ ": u"oraș"}
+    _label_types = {1: u"mun.", 2: u"oraș", 3: u"com.", 4: u"mun.",
+                    5: u"oraș", 40: u"jud."}
+
+    def __group_table(self, fields):
+        """
+        Get the entity counts grouped by ``fields``, derived from a
+        table grouped by all the group fields that is built on first use
+
+        """
+        fields = tuple(fields)
+        if ('group', fields) not in self._indexes:
+            group_fields = tuple(field for field in self._group_fields
+                                 if field in self._loaded_fields)
+            if ('group', group_fields) not in self._indexes:
+                columns = self._columns()
+                self._indexes[('group', group_fields)] = collections.Counter(
+                    zip(*[columns[field] for field in group_fields]))
+            table = collections.Counter()
+            positions = [group_fields.index(field) for field in fields]
+            for key, count in self._indexes[('group', group_fields)].items():
+                table[tuple(key[position] for position in positions)] += count
+            self._indexes[('group', fields)] = table
+        return self._indexes[('group', fields)]
+
+    def __check_group_fields(self, fields):
+        if type(fields) is not list or not fields or \
+           any(field not in self._group_fields for field in fields):
+            self.__notify_error("Invalid field list required")
+            return False
+        return self._has_fields(fields)
+
+    def count_by(self, fields):
+        """
+        Count the entities grouped by one or more of ``county``, ``type``,
+        ``region`` and ``urban``. The counts are computed once and
+        cached, so repeated queries are dictionary lookups.
+
+        :param fields: the fields to group by
+        :type fields: list
+
+        :return: a dictionary of field value (or tuple of values for \
+        several fields) to the number of entities, or ``None`` for \
+        invalid fields
+        :rtype: dict
+
+        """
+        if not self.__check_group_fields(fields):
+            return None
+        table = self.__group_table(fields)
+        if len(fields) == 1:
+            return dict((key[0], count) for key, count in table.items())
+        return dict(table)
+
+    def rollup(self, fields):
+        """
+        Count the entities grouped by ``fields``, with subtotals for
+        every prefix of ``fields`` and a grand total, like SQL's
+        ``GROUP BY ROLLUP``
+
+        :param fields: the fields to group by, from the outermost to the \
+        innermost level
+        :type fields: list
+
+        :return: a dictionary of value tuples to counts; levels that are \
+        rolled up are ``None`` in the keys, e.g. ``(1, None)`` is the \
+        total for county 1 and ``(None, None)`` the grand total
+        :rtype: dict
+
+        """
+        if not self.__check_group_fields(fields):
+            return None
+        ret = {}
+        for level in range(len(fields), -1, -1):
+            padding = (None,) * (len(fields) - level)
+            for key, count in self.__group_table(fields[:level]).items():
+                ret[key + padding] = count
         return ret
 
+    def count_subtree(self, siruta, by=None):
+        """
+        Count the entities below the given one in the hierarchy
+
+        :param siruta: The SIRUTA code of the subtree root
+        :type siruta: int
+        :param by: optionally one of ``county``, ``type``, ``region`` \
+        and ``urban``, to group the counts by
+        :type by: string
+
+        :return: the number of descendants, or a dictionary of field \
+        value to number of descendants if ``by`` is given; ``None`` if \
+        the code is not in the database
+        :rtype: int or dict
+
+        """
+        if siruta not in self._data:
+            self.__notify_error("SIRUTA code %d is not in the database" % siruta)
+            return None
+        if by is not None and by not in self._group_fields:
+            self.__notify_error("Invalid field required")
+            return None
+        if not self._has_fields(['sirutasup'] + ([by] if by is not None else [])):
+            return None
+        if ('subtree', by) not in self._indexes:
+            self._indexes[('subtree', by)] = self.__subtree_counts(by)
+        counts = self._indexes[('subtree', by)].get(siruta)
+        if by is None:
+            return counts or 0
+        return dict(counts or {})
+
+    def __subtree_counts(self, by):
+        """
+        Accumulate the descendant counts of every entity, from the
+        deepest entities up
+
+        """
+        columns = self._columns()
+        parents = dict(zip(columns['siruta'], columns['sirutasup']))
+        values = columns[by] if by is not None else [None] * len(parents)
+        depths = {}
+        for code in parents:
+            path = []
+            while code in parents and code not in depths and code not in path:
+                path.append(code)
+                code = parents[code]
+            depth = depths.get(code, 0)
+            for code in reversed(path):
+                depth += 1
+                depths[code] = depth
+        own = dict(zip(columns['siruta'], values))
+        counts = {}
+        for code in sorted(parents, key=depths.get, reverse=True):
+            parent = parents[code]
+            if parent not in parents or parent == code:
+                continue
+            if by is None:
+                counts[parent] = counts.get(parent, 0) + counts.get(code, 0) + 1
+            else:
+                total = counts.setdefault(parent, collections.Counter())
+                total.update(counts.get(code, {}))
+                total[own[code]] += 1
+        return counts
+
+    _rollup_levels = ('commune', 'county', 'region')
+
+    def __rollup_index(self):
+        """
+        Build on first use the code index of the rows and, for every
+        row, the code of its commune (the level 2 entity it belongs to,
+        i.e. a commune, town or municipality), the code of its county
+        and its region, ``-1`` standing for none
+
+        """
+        if 'rollup' not in self._indexes:
+            columns = self._columns()
+            parents = dict(zip(columns['siruta'], columns['sirutasup']))
+            levels = dict(zip(columns['siruta'], columns['level']))
+            types = dict(zip(columns['siruta'], columns['type']))
+            targets = {'commune': array.array('i'), 'county': array.array('i')}
+            if 'region' in columns:
+                targets['region'] = array.array('i', columns['region'])
+            for code in columns['siruta']:
+                commune = county = -1
+                seen = set()
+                while code in parents and code not in seen:
+                    seen.add(code)
+                    if types[code] == 40:
+                        county = code
+                        break
+                    if levels[code] == '2' and commune == -1:
+                        commune = code
+                    code = parents[code]
+                targets['commune'].append(commune)
+                targets['county'].append(county)
+            self._indexes['rollup'] = (_CodeIndex(columns['siruta']), targets)
+        return self._indexes['rollup']
+
+    def rollup_values(self, values, levels=None, agg=sum):
+        """
+        Aggregate values attached to entities, e.g. the population of
+        the villages, per commune, county and region. The superior
+        entities of every entity are computed once, so the values are
+        aggregated in a single pass.
+
+        :param values: a dictionary of SIRUTA code to value, or a pair \
+        of sequences (or NumPy arrays) with the codes and the values; \
+        in the latter case a code can appear several times
+        :type values: dict or tuple
+        :param levels: the levels to aggregate to, among ``commune`` \
+        (the commune, town or municipality), ``county`` and ``region``; \
+        all of them by default
+        :type levels: list
+        :param agg: the function aggregating the list of values of each \
+        entity, e.g. ``sum``, ``max`` or ``len``; with ``sum`` the values \
+        are added as they are read and NumPy arrays are added in one \
+        vectorized operation
+        :type agg: function
+
+        :return: a dictionary of level to a dictionary of the SIRUTA \
+        code of the commune or county (or the region number) to the \
+        aggregated value, or ``None`` if the levels are invalid. The \
+        values of codes not in the database are skipped, with a warning.
+        :rtype: dict
+
+        """
+        if levels is None:
+            levels = list(self._rollup_levels)
+        if type(levels) is not list or \
+           any(level not in self._rollup_levels for level in levels):
+            self.__notify_error("Invalid level list required")
+            return None
+        needed = ['sirutasup', 'level', 'type']
+        if 'region' in levels:
+            needed.append('region')
+        if not self._has_fields(needed):
+            return None
+        index, targets = self.__rollup_index()
+        if isinstance(values, dict):
+            codes, values = list(values.keys()), list(values.values())
+        else:
+            codes, values = values
+        if agg is sum and type(codes).__module__ == 'numpy':
+            ret, missing = self.__rollup_arrays(index, targets, codes, values, levels)
+        else:
+            ret, missing = self.__rollup_lists(index, targets, codes, values,
+                                               levels, agg)
+        if missing:
+            self.__notify_error("%d values have codes that are not in the "
+                                "database" % missing)
+        return ret
+
+    @staticmethod
+    def __rollup_lists(index, targets, codes, values, levels, agg):
+        """Aggregate sequences of codes and values to each level"""
+        ret = dict((level, {}) for level in levels)
+        tables = [(ret[level], targets[level]) for level in levels]
+        get = index.get
+        missing = 0
+        for code, value in zip(codes, values):
+            row = get(code)
+            if row is None:
+                missing += 1
+                continue
+            for totals, table in tables:
+                key = table[row]
+                if key == -1:
+                    continue
+                if agg is sum:
+                    totals[key] = totals.get(key, 0) + value
+                elif key in totals:
+                    totals[key].append(value)
+                else:
+                    totals[key] = [value]
+        if agg is not sum:
+            for level in levels:
+                ret[level] = dict((key, agg(group))
+                                  for key, group in ret[level].items())
+        return ret, missing
+
+    @staticmethod
+    def __rollup_arrays(index, targets, codes, values, levels):
+        """Add NumPy arrays of codes and values to each level"""
+        np = _require("numpy")
+        values = np.asarray(values)
+        table = np.frombuffer(index._table, dtype='u2' if index._table.itemsize == 2
+                              else 'i4').astype('i8')
+        table[table == index._missing] = -1
+        positions = np.asarray(codes, dtype='i8') - index._base
+        found = (positions >= 0) & (positions < len(table))
+        rows = np.full(len(positions), -1, dtype='i8')
+        rows[found] = table[positions[found]]
+        found = rows != -1
+        rows, values = rows[found], values[found]
+        ret = {}
+        for level in levels:
+            keys = np.frombuffer(targets[level], dtype='i4')[rows]
+            selected = keys != -1
+            keys = keys[selected]
+            if not len(keys):
+                ret[level] = {}
+                continue
+            totals = np.zeros(keys.max() + 1, dtype=values.dtype)
+            np.add.at(totals, keys, values[selected])
+            present = np.flatnonzero(np.bincount(keys))
+            ret[level] = dict(zip(present.tolist(), totals[present].tolist()))
+        return ret, int(len(found) - found.sum())
+
     def __normalize_string(self, string):
         """
         Return a string formatting according to the current
@@ -290,20 +2280,103 @@ class SirutaDatabase:
             siruta = int(siruta)
         if siruta >= 10**6:
             return False
-        weights = [1, 2, 3, 5, 7]
         checksum = 0
         checkdigit = siruta % 10
-        index = 0
-        while (index < 5):
+        for weight in (1, 2, 3, 5, 7):
             siruta = int(siruta / 10)
-            left = (siruta % 10) * weights[index]
-            checksum += sum(map(int, str(left)))  # sum of digits of left
-            index += 1
+            left = (siruta % 10) * weight
+            checksum += left // 10 + left % 10  # sum of digits of left
         checksum %= 10
         checksum = 11 - checksum
         checksum %= 10
         return checksum == checkdigit
 
+    def __deletes_index(self):
+        """
+        Build on first use the symmetric deletion index: every string
+        obtained by removing up to two digits from an existing, valid
+        code, mapped to those codes
+
+        """
+        if 'deletes' not in self._indexes:
+            index = collections.defaultdict(list)
+            for code in self._data:
+                if not self.siruta_is_valid(code):
+                    continue
+                for variant in _digit_deletes(str(code), 2):
+                    index[variant].append(code)
+            self._indexes['deletes'] = dict(index)
+        return self._indexes['deletes']
+
+    def get_extractor(self, cache=None):
+        """Get an extractor for the entities mentioned in free-text \
+        addresses, built on first use
+
+        :param cache: the file the extractor's automaton is read from \
+        or written to
+        :type cache: string
+
+        :return: the extractor, or ``None`` if the names, superior codes \
+        or types were not loaded
+        :rtype: SirutaExtractor
+
+        """
+        if not self._has_fields(['name', 'sirutasup', 'type']):
+            return None
+        if 'extractor' not in self._indexes:
+            self._indexes['extractor'] = SirutaExtractor(self, cache)
+        return self._indexes['extractor']
+
+    def suggest_codes(self, siruta, county_hint=None, max_distance=2, limit=10):
+        """
+        Suggest existing codes for a mistyped SIRUTA code, i.e. codes
+        that can be obtained by inserting, removing, changing or swapping
+        at most ``max_distance`` digits
+
+        :param siruta: The wrong SIRUTA code
+        :type siruta: int or string
+        :param county_hint: the county the entity is expected to be in; \
+        codes from this county are ranked first
+        :type county_hint: int
+        :param max_distance: the maximum number of edits, 1 or 2
+        :type max_distance: int
+        :param limit: the maximum number of suggestions
+        :type limit: int
+
+        :return: valid codes from the database, the most plausible first: \
+        fewer edits, then the hinted county, then swapped digits before \
+        other edits
+        :rtype: list
+
+        """
+        text = str(siruta).strip()
+        if not text.isdecimal() or max_distance not in (1, 2):
+            self.__notify_error("Invalid SIRUTA code required")
+            return []
+        if county_hint is not None and not self._has_fields(['county']):
+            return []
+        text = str(int(text))
+        index = self.__deletes_index()
+        candidates = set()
+        for variant in _digit_deletes(text, max_distance):
+            candidates.update(index.get(variant, ()))
+        distance_from_text = _edit_distance_from(text)
+        digits = sorted(text)
+        ranked = []
+        for code in candidates:
+            other = str(code)
+            if abs(len(other) - len(text)) > max_distance:
+                continue
+            distance = distance_from_text(other)
+            if distance == 0 or distance > max_distance:
+                continue
+            other_county = county_hint is not None and \
+                self._data[code]['county'] != county_hint
+            ranked.append((distance, other_county, digits != sorted(other),
+                           code))
+        ranked.sort()
+        return [entry[-1] for entry in ranked[:limit]]
+
     def get_last_error(self):
         return self._last_error
 
@@ -353,14 +2426,31 @@ class SirutaDatabase:
         :rtype: string
 
         """
-        if siruta not in self._data:
+        name = self.__get_field(siruta, 'name')
+        if name is None:
+            return None
+        return self._format_name(name, prefix)
+
+    def __get_field(self, siruta, field):
+        """
+        Get a field of the entity with the given code, or ``None`` if
+        the code is not in the database or the field was not loaded
+
+        """
+        data = self._data
+        if siruta not in data:
             self.__notify_error("SIRUTA code %d is not in the database" % siruta)
             return None
+        if not self._all_fields_loaded and not self._has_fields((field,)):
+            return None
+        return data[siruta][field]
 
+    def _format_name(self, name, prefix=True):
+        """Format a name from the database according to the \
+        current diacritics settings, optionally removing its prefix"""
         if prefix:
-            return self.__normalize_string(self._data[siruta]['name'])
+            return self.__normalize_string(name)
         else:
-            name = self._data[siruta]['name']
             for i in range(len(self._prefixes)):
                 name = name.replace(self._prefixes[i], "")
             return self.__normalize_string(name.strip())
@@ -377,11 +2467,7 @@ class SirutaDatabase:
         :rtype: string
 
         """
-        if siruta not in self._data:
-            self.__notify_error("SIRUTA code %d is not in the database" % siruta)
-            return None
-
-        return self._data[siruta]['sirutasup']
+        return self.__get_field(siruta, 'sirutasup')
 
     def get_sup_name(self, siruta, prefix=True):
         """Get the superior entity name for the given siruta code
@@ -402,23 +2488,17 @@ class SirutaDatabase:
         if supcode is None:
             return None
 
-        if supcode not in self._data:
-            self.__notify_error("SIRUTA code %d is not in the database" % supcode)
-            return None
-
-        if prefix:
-            return self.__normalize_string(self._data[supcode]['name'])
-        else:
-            name = self._data[supcode]['name']
-            for i in range(len(self._prefixes)):
-                name = name.replace(self._prefixes[i], "")
-            return self.__normalize_string(name.strip())
+        return self.get_name(supcode, prefix)
 
-    def get_postal_code(self, siruta):
+    def get_postal_code(self, siruta, resolve=False):
         """Get the entity's postal code for the given siruta code
 
         :param siruta: The SIRUTA code for which we want the postal code
         :type siruta: int
+        :param resolve: if the entity has more than one postal code, \
+        return the postal code of its seat or of the nearest superior \
+        entity that has only one
+        :type resolve: bool
 
         :return: The postal code of the entity, ``None`` if the SIRUTA\
         code is not in the database or ``0`` if the entity has more than\
@@ -426,11 +2506,120 @@ class SirutaDatabase:
         :rtype: string
 
         """
-        if siruta not in self._data:
-            self.__notify_error("SIRUTA code %d is not in the database" % siruta)
-            return None
+        postcode = self.__get_field(siruta, 'postcode')
+        if postcode == 0 and resolve:
+            if not self._has_fields(self._postcode_fields):
+                return None
+            postcode = self.__postcode_index()[2].get(siruta, 0)
+        return postcode
+
+    # the fields needed by the postal code index
+    _postcode_fields = ['postcode', 'type', 'sirutasup']
 
-        return self._data[siruta]['postcode']
+    def __postcode_index(self):
+        """
+        Build the postal code index on first use: the sorted postal
+        codes, the SIRUTA codes in the same order and the resolved
+        postal codes of the entities with more than one postal code.
+
+        An entity with several postal codes is resolved to the postal
+        code of its seat (e.g. the village hosting the commune hall),
+        or to that of the nearest superior entity or of its seat.
+
+        """
+        if 'postcode' not in self._indexes:
+            entries = []
+            seats = {}
+            for position, entry in enumerate(self._data.values()):
+                if entry['postcode'] != 0:
+                    entries.append((entry['postcode'], position, entry['siruta']))
+                if entry['type'] in self._seat_types:
+                    seats[entry['sirutasup']] = entry['siruta']
+            resolved = {}
+            for entry in self._data.values():
+                if entry['postcode'] != 0:
+                    continue
+                sup = entry['siruta']
+                seen = set()
+                while sup in self._data and sup not in seen and \
+                        entry['siruta'] not in resolved:
+                    seen.add(sup)
+                    seat = sup
+                    while seat in self._data:
+                        if self._data[seat]['postcode'] != 0:
+                            resolved[entry['siruta']] = self._data[seat]['postcode']
+                            break
+                        seat = seats.get(seat)
+                    sup = self._data[sup]['sirutasup']
+            entries.sort()
+            self._indexes['postcode'] = ([entry[0] for entry in entries],
+                                         [entry[2] for entry in entries],
+                                         resolved)
+        return self._indexes['postcode']
+
+    def get_codes_by_postcode_range(self, first, last, as_set=False):
+        """Get the entities with a postal code between ``first`` and \
+        ``last``, inclusive
+
+        :param first: The first postal code of the range
+        :type first: int
+        :param last: The last postal code of the range
+        :type last: int
+        :param as_set: Return a :class:`SirutaSet` instead of a list
+        :type as_set: bool
+
+        :return: the SIRUTA codes ordered by postal code, or an empty \
+        list if there is no such entity
+        :rtype: list
+
+        """
+        if as_set:
+            return SirutaSet(self.get_codes_by_postcode_range(first, last))
+        if type(first) is not int or type(last) is not int:
+            self.__notify_error("Invalid postal code required")
+            return []
+        if not self._has_fields(self._postcode_fields):
+            return []
+        postcodes, codes, resolved = self.__postcode_index()
+        start = bisect.bisect_left(postcodes, first)
+        end = bisect.bisect_right(postcodes, last)
+        return codes[start:end]
+
+    def get_codes_by_postcode(self, postcode, as_set=False):
+        """Get the entities with the given postal code
+
+        :param postcode: The postal code
+        :type postcode: int
+        :param as_set: Return a :class:`SirutaSet` instead of a list
+        :type as_set: bool
+
+        :return: the SIRUTA codes of the entities, or an empty list if \
+        there is no such entity
+        :rtype: list
+
+        """
+        return self.get_codes_by_postcode_range(postcode, postcode, as_set)
+
+    def get_codes_by_postcode_prefix(self, prefix, as_set=False):
+        """Get the entities whose postal code starts with the given \
+        digits, e.g. ``"51"`` for all postal codes between 510000 and \
+        519999
+
+        :param prefix: The first digits of the postal code
+        :type prefix: string
+        :param as_set: Return a :class:`SirutaSet` instead of a list
+        :type as_set: bool
+
+        :return: the SIRUTA codes ordered by postal code
+        :rtype: list
+
+        """
+        if type(prefix) is not str or not prefix.isdecimal() or len(prefix) > 6:
+            self.__notify_error("Invalid postal code prefix required")
+            return SirutaSet() if as_set else []
+        return self.get_codes_by_postcode_range(int(prefix.ljust(6, "0")),
+                                                int(prefix.ljust(6, "9")),
+                                                as_set)
 
     def get_type(self, siruta):
         """Get the entity's type for the given siruta code
@@ -442,11 +2631,7 @@ class SirutaDatabase:
         :rtype: int
 
         """
-        if siruta not in self._data:
-            self.__notify_error("SIRUTA code %d is not in the database" % siruta)
-            return None
-
-        return self._data[siruta]['type']
+        return self.__get_field(siruta, 'type')
 
     def get_type_string(self, siruta):
         """Get the entity's type for the given siruta code as string
@@ -459,11 +2644,14 @@ class SirutaDatabase:
         :rtype: string
 
         """
-        if siruta not in self._data:
-            self.__notify_error("SIRUTA code %d is not in the database" % siruta)
+        type_ = self.__get_field(siruta, 'type')
+        if type_ is None:
             return None
+        return self._format_type(type_)
 
-        type_ = self._data[siruta]['type']
+    def _format_type(self, type_):
+        """Get the description of a type code formatted according to \
+        the current diacritics settings, or ``None`` for unknown types"""
         if type_ in self._village_type:
             return self.__normalize_string(self._village_type[type_])
         else:
@@ -479,11 +2667,7 @@ class SirutaDatabase:
         :rtype: int
 
         """
-        if siruta not in self._data:
-            self.__notify_error("SIRUTA code %d is not in the database" % siruta)
-            return None
-
-        return self._data[siruta]['county']
+        return self.__get_field(siruta, 'county')
 
     def get_county_string(self, siruta, prefix=True):
         """Get the entity's county for the given siruta code as string
@@ -494,11 +2678,14 @@ class SirutaDatabase:
         :rtype: string
 
         """
-        if siruta not in self._data:
-            self.__notify_error("SIRUTA code %d is not in the database" % siruta)
+        county = self.__get_field(siruta, 'county')
+        if county is None:
             return None
+        return self._format_county(county, prefix)
 
-        county = self._data[siruta]['county']
+    def _format_county(self, county, prefix=True):
+        """Get the name of a county code formatted according to the \
+        current diacritics settings, or ``None`` for unknown counties"""
         if county in self._counties:
             if prefix:
                 return self.__normalize_string(self._counties[county])
@@ -530,11 +2717,7 @@ class SirutaDatabase:
         :rtype: int
 
         """
-        if siruta not in self._data:
-            self.__notify_error("SIRUTA code %d is not in the database" % siruta)
-            return None
-
-        return self._data[siruta]['region']
+        return self.__get_field(siruta, 'region')
 
     def get_region_string(self, siruta):
         """Get the entity's region for the given code as string
@@ -546,11 +2729,7 @@ class SirutaDatabase:
         :rtype: int
 
         """
-        if siruta not in self._data:
-            self.__notify_error("SIRUTA code %d is not in the database" % siruta)
-            return None
-
-        region = self._data[siruta]['region']
+        region = self.__get_field(siruta, 'region')
         if region in self._regions:
             return self._regions[region]
         else:
@@ -568,6 +2747,168 @@ class SirutaDatabase:
         """
         return self.get_region_string(siruta)
 
+    def get_label(self, siruta, style="full"):
+        """Get a label identifying the entity unambiguously, e.g. \
+        ``VALEA MARE, com. PRIBOIENI, jud. ARGEȘ``. Labels are \
+        memoized for every style and diacritics setting.
+
+        :param siruta: The SIRUTA code for which we want the label
+        :type siruta: int
+        :param style: ``full`` for the name followed by the superior \
+        entity and the county, ``short`` for the name and the county only
+        :type style: string
+
+        :return: the label or ``None`` if the code is not in the database
+        :rtype: string
+
+        """
+        if style not in ("full", "short"):
+            self.__notify_error("Invalid label style required")
+            return None
+        labels = self._indexes.setdefault(('label', style, self._dia), {})
+        if siruta in labels:
+            return labels[siruta]
+        if siruta not in self._data:
+            self.__notify_error("SIRUTA code %d is not in the database" % siruta)
+            return None
+        if not self._has_fields(['name', 'type', 'county', 'sirutasup']):
+            return None
+
+        if 'county_codes' not in self._indexes:
+            self._indexes['county_codes'] = dict(
+                (self._data[code]['county'], code)
+                for code in self.get_siruta_list(type_list=[40]))
+        county = self._indexes['county_codes'].get(self._data[siruta]['county'])
+        parts = [siruta]
+        sup = self._data[siruta]['sirutasup']
+        if style == "full" and sup in self._data and sup != county and \
+           self._data[siruta]['type'] not in self._label_types:
+            parts.append(sup)
+        if county is not None and county not in parts:
+            parts.append(county)
+        names = []
+        for code in parts:
+            name = self.__label_part(code)
+            if not names or names[-1] != name:  # e.g. Bucharest
+                names.append(name)
+        label = u", ".join(names)
+        labels[siruta] = label
+        return label
+
+    def get_labels(self, codes, style="full"):
+        """Get the labels for several codes, see :meth:`get_label`
+
+        :param codes: The SIRUTA codes for which we want the labels
+        :type codes: list
+        :param style: the label style
+        :type style: string
+
+        :return: the labels, with ``None`` for codes not in the database
+        :rtype: list
+
+        """
+        return [self.get_label(code, style) for code in codes]
+
+    def __label_part(self, siruta):
+        """The name of one entity in a label, with its abbreviated type"""
+        entry = self._data[siruta]
+        name = entry['name']
+        abbreviation = None
+        for prefix in self._prefixes:
+            if name.startswith(prefix) and prefix in self._label_prefixes:
+                abbreviation = self._label_prefixes[prefix]
+                name = name[len(prefix):]
+                break
+        if abbreviation is None:
+            abbreviation = self._label_types.get(entry['type'])
+        if abbreviation is not None:
+            name = abbreviation + u" " + name
+        return self.__normalize_string(name)
+
+    def select(self, query, as_set=False):
+        """Get the codes of the entities matching a filter expression
+
+        :param query: the expression, e.g. ``region in (7, 8) and \
+        urban and name ~ "VALEA*"``, or a query already compiled with \
+        :func:`compile_query`; see :class:`SirutaQuery` for the syntax
+        :type query: string or SirutaQuery
+        :param as_set: Return a :class:`SirutaSet` instead of a list
+        :type as_set: bool
+
+        :return: the matching codes in ascending order, or an empty list \
+        if the expression is invalid
+        :rtype: list
+
+        """
+        if not isinstance(query, (SirutaQuery, str)):
+            self.__notify_error("Invalid query required")
+            return SirutaSet() if as_set else []
+        if not isinstance(query, SirutaQuery):
+            try:
+                query = compile_query(query)
+            except (ValueError, TypeError) as e:
+                self.__notify_error("Invalid query: %s" % e)
+                return SirutaSet() if as_set else []
+        if not self._has_fields(sorted(query.fields)):
+            return SirutaSet() if as_set else []
+        ret = query.execute(self)
+        return ret if as_set else ret.to_list()
+
+    def get_entity(self, siruta):
+        """Get all the data about an entity with a single lookup
+
+        :param siruta: The SIRUTA code of the entity
+        :type siruta: int
+
+        :return: a read-only record or ``None`` if the code is not in \
+        the database or not all the fields were loaded
+        :rtype: SirutaEntity
+
+        """
+        if siruta not in self._data:
+            self.__notify_error("SIRUTA code %d is not in the database" % siruta)
+            return None
+        if not self._has_fields(self._fields):
+            return None
+        if isinstance(self._data, _ColumnarRows):
+            return SirutaEntity(self, self._data, self._data.position(siruta))
+        return SirutaEntity(self, self._data[siruta])
+
+    def iter_entities(self, codes=None, where=None):
+        """Iterate over entities without building a list
+
+        :param codes: the codes to return, e.g. a :class:`SirutaSet`; \
+        all the entities are returned in file order by default, codes \
+        that are not in the database are skipped
+        :type codes: iterable
+        :param where: a function receiving a :class:`SirutaEntity` and \
+        returning ``True`` for the entities to return
+        :type where: callable
+
+        :return: a generator of read-only records, empty if not all the \
+        fields were loaded
+        :rtype: generator
+
+        """
+        if not self._has_fields(self._fields):
+            return
+        data = self._data
+        if isinstance(data, _ColumnarRows):
+            if codes is None:
+                positions = range(len(data))
+            else:
+                positions = (data.position(code) for code in codes
+                             if code in data)
+            entities = (SirutaEntity(self, data, index) for index in positions)
+        elif codes is None:
+            entities = (SirutaEntity(self, row) for row in data.values())
+        else:
+            entities = (SirutaEntity(self, data[code]) for code in codes
+                        if code in data)
+        for entity in entities:
+            if where is None or where(entity):
+                yield entity
+
     def get_inf_codes(self, siruta):
         """Get all the entities that have the given siruta code as \
         superior code
@@ -585,14 +2926,10 @@ class SirutaDatabase:
         if siruta not in self._data:
             self.__notify_error("SIRUTA code %d is not in the database" % siruta)
             return None
+        if not self._has_fields(['sirutasup']):
+            return None
 
-        ret = []
-
-        for entry in self._data:
-            if self._data[entry]['sirutasup'] == siruta:
-                ret.append(entry)
-
-        return ret
+        return list(self.__children_index().get(siruta, []))
 
     def get_all_counties(self, prefix=True):
         """Get all county names from the database
@@ -645,3 +2982,1535 @@ class SirutaDatabase:
     def get_region_by_name(self, name):
         """Get the entity's region for the given name"""
         raise NotImplementedError()
+
+
+"""
+---------------
+Query language
+---------------
+"""
+
+
+class SirutaQuery(object):
+    """
+    A compiled filter expression, built by :func:`compile_query` and
+    run with :meth:`SirutaDatabase.select`.
+
+    Expressions combine comparisons with ``and``, ``or``, ``not`` and
+    parentheses, e.g.
+    ``region in (7, 8) and urban and type in (9, 17) and name ~ "VALEA*"``.
+
+    The fields are ``siruta`` (or ``code``), ``name``, ``postcode`` (or
+    ``postal_code``), ``county``, ``sirutasup`` (or ``sup_code``),
+    ``type``, ``level``, ``urban`` and ``region``. The operators are
+    ``=``, ``!=``, ``<``, ``<=``, ``>``, ``>=``, ``in`` followed by a
+    parenthesized list and ``~`` followed by a shell-style pattern. A
+    field on its own is true if its value is. The name and the level
+    are compared to strings, names in upper case, and ``~`` only
+    applies to them; the other fields are compared to integers.
+
+    Comparisons on the county, type, region and urban status are
+    answered from the bitmap indexes of the database; the other ones
+    are compiled to a Python predicate which is only applied to the
+    entities left by the indexed comparisons.
+
+    """
+    _aliases = {'code': 'siruta', 'postal_code': 'postcode',
+                'sup_code': 'sirutasup'}
+    _indexed = ('county', 'type', 'region', 'urban')
+    _string_fields = ('name', 'level')
+    _token = re.compile(r'\s*(?:(-?\d+)|"((?:[^"\\]|\\.)*)"|'
+                        r'(==|!=|<=|>=|[=<>~(),])|([A-Za-z_]+))')
+
+    def __init__(self, text):
+        self.text = text
+        self._tokens = self.__tokenize(text)
+        self._position = 0
+        self._patterns = []
+        # the fields the query reads
+        self.fields = set()
+        tree = self.__parse_or()
+        if self._position != len(self._tokens):
+            raise ValueError("Unexpected %r in query" % (self._tokens[self._position][1],))
+        self._plan = self.__plan(tree)
+        del self._tokens
+
+    def __tokenize(self, text):
+        tokens = []
+        position = 0
+        text = text.rstrip()
+        while position < len(text):
+            match = self._token.match(text, position)
+            if match is None:
+                raise ValueError("Invalid query near %r" % text[position:])
+            number, string, operator, word = match.groups()
+            if number is not None:
+                tokens.append(('value', int(number)))
+            elif string is not None:
+                tokens.append(('value', re.sub(r'\\(.)', r'\1', string)))
+            elif operator is not None:
+                tokens.append(('op', operator))
+            elif word.lower() in ('and', 'or', 'not', 'in'):
+                tokens.append(('op', word.lower()))
+            elif word.lower() in ('true', 'false'):
+                tokens.append(('value', word.lower() == 'true'))
+            else:
+                tokens.append(('field', word))
+            position = match.end()
+        return tokens
+
+    def __peek(self):
+        if self._position < len(self._tokens):
+            return self._tokens[self._position]
+        return (None, None)
+
+    def __next(self, kind=None, value=None):
+        token = self.__peek()
+        if token[0] is None or (kind is not None and token[0] != kind) or \
+           (value is not None and token[1] != value):
+            raise ValueError("Expected %s in query %r" % (value or kind, self.text))
+        self._position += 1
+        return token[1]
+
+    def __parse_or(self):
+        nodes = [self.__parse_and()]
+        while self.__peek() == ('op', 'or'):
+            self.__next()
+            nodes.append(self.__parse_and())
+        return nodes[0] if len(nodes) == 1 else ('or', nodes)
+
+    def __parse_and(self):
+        nodes = [self.__parse_not()]
+        while self.__peek() == ('op', 'and'):
+            self.__next()
+            nodes.append(self.__parse_not())
+        return nodes[0] if len(nodes) == 1 else ('and', nodes)
+
+    def __parse_not(self):
+        if self.__peek() == ('op', 'not'):
+            self.__next()
+            return ('not', self.__parse_not())
+        if self.__peek() == ('op', '('):
+            self.__next()
+            node = self.__parse_or()
+            self.__next('op', ')')
+            return node
+        return self.__parse_comparison()
+
+    def __parse_comparison(self):
+        field = self.__next('field')
+        field = self._aliases.get(field, field)
+        if field not in SirutaDatabase._fields:
+            raise ValueError("Unknown field %s in query" % field)
+        self.fields.add(field)
+        kind, operator = self.__peek()
+        if kind != 'op' or operator not in ('=', '==', '!=', '<', '<=', '>',
+                                            '>=', 'in', '~'):
+            return ('cmp', field, 'is', True)
+        self.__next()
+        if operator == 'in':
+            self.__next('op', '(')
+            values = [self.__next('value')]
+            while self.__peek() == ('op', ','):
+                self.__next()
+                values.append(self.__next('value'))
+            self.__next('op', ')')
+            value = values
+        else:
+            value = self.__next('value')
+        self.__check_values(field, operator,
+                            value if operator == 'in' else [value])
+        if field == 'name':
+            value = [v.upper() for v in value] if operator == 'in' else value.upper()
+        if operator == '~':
+            value = re.compile(fnmatch.translate(value)).match
+        return ('cmp', field, '==' if operator == '=' else operator, value)
+
+    def __check_values(self, field, operator, values):
+        if operator == '~' and field not in self._string_fields:
+            raise ValueError("Operator ~ needs a string field, not %s" % field)
+        if field in self._string_fields:
+            kinds = (str,)
+        elif field == 'urban':
+            kinds = (bool, int)
+        else:
+            kinds = (int,)
+        for value in values:
+            if type(value) not in kinds:
+                raise ValueError("Invalid value %r for field %s in query"
+                                 % (value, field))
+
+    def __plan(self, node):
+        """
+        Turn the syntax tree into a plan: comparisons that the bitmap
+        indexes can answer stay as they are, the others are grouped per
+        ``and`` node into one compiled predicate
+
+        """
+        if node[0] == 'cmp':
+            if self.__is_indexed(node):
+                return node
+            return ('scan', self.__compile([node]))
+        if node[0] == 'not':
+            return ('not', self.__plan(node[1]))
+        children = node[1]
+        if node[0] == 'and':
+            indexed = [child for child in children if self.__is_indexed(child)]
+            rest = [child for child in children if not self.__is_indexed(child)]
+            plans = indexed + [self.__plan(child) for child in rest
+                               if child[0] != 'cmp']
+            scanned = [child for child in rest if child[0] == 'cmp']
+            if scanned:
+                plans.append(('scan', self.__compile(scanned)))
+            return ('and', plans)
+        return ('or', [self.__plan(child) for child in children])
+
+    def __is_indexed(self, node):
+        # a field on its own is only answered from the bitmap indexes
+        # for the urban status, the other fields are true when non-zero
+        return node[0] == 'cmp' and node[1] in self._indexed and \
+            (node[2] in ('==', 'in') or node[1] == 'urban' and node[2] == 'is')
+
+    def __compile(self, nodes):
+        """Compile comparisons joined by ``and`` to one function"""
+        clauses = []
+        for node, field, operator, value in nodes:
+            if operator == 'is':
+                clauses.append("bool(r[%r])" % field)
+            elif operator == '~':
+                self._patterns.append(value)
+                clauses.append("(p[%d](r[%r]) is not None)" %
+                               (len(self._patterns) - 1, field))
+            elif operator == 'in':
+                clauses.append("(r[%r] in %r)" % (field, tuple(value)))
+            else:
+                clauses.append("(r[%r] %s %r)" % (field, operator, value))
+        return eval("lambda r: " + " and ".join(clauses),
+                    {'__builtins__': {'bool': bool}, 'p': self._patterns})
+
+    def execute(self, db):
+        """
+        Run the query on a database
+
+        :param db: the database
+        :type db: SirutaDatabase
+
+        :return: the matching codes
+        :rtype: SirutaSet
+
+        """
+        return self.__execute(self._plan, db, None)
+
+    def __execute(self, plan, db, candidates):
+        """
+        Return the codes matching ``plan`` among ``candidates``, all the
+        entities if ``candidates`` is ``None``
+
+        """
+        if plan[0] == 'cmp':
+            matches = self.__execute_indexed(plan, db)
+            return matches if candidates is None else matches & candidates
+        if plan[0] == 'scan':
+            return self.__execute_scan(plan[1], db, candidates)
+        if plan[0] == 'not':
+            everything = db.get_siruta_set() if candidates is None else candidates
+            return everything - self.__execute(plan[1], db, candidates)
+        if plan[0] == 'and':
+            for child in plan[1]:
+                candidates = self.__execute(child, db, candidates)
+            return candidates
+        ret = SirutaSet()
+        for child in plan[1]:
+            ret = ret | self.__execute(child, db, candidates)
+        return ret
+
+    def __execute_indexed(self, plan, db):
+        """Answer a comparison from the bitmap indexes of the database"""
+        field, operator, value = plan[1:]
+        values = value if operator == 'in' else [value]
+        if field != 'urban':
+            return db.get_siruta_set(**{field + '_list': list(values)})
+        matches = SirutaSet()
+        for v in set(bool(v) for v in values):
+            matches = matches | db.get_siruta_set(urban=v)
+        return matches
+
+    def __execute_scan(self, predicate, db, candidates):
+        """Apply a compiled predicate to the candidates"""
+        if candidates is None:
+            rows = db._data.values()
+        else:
+            rows = (db._data[code] for code in candidates)
+        return SirutaSet(row['siruta'] for row in rows if predicate(row))
+
+
+@functools.lru_cache(maxsize=256)
+def compile_query(text):
+    """
+    Compile a filter expression, see :class:`SirutaQuery`. Compiled
+    queries are cached, so the same text is only parsed once.
+
+    :param text: the filter expression
+    :type text: string
+
+    :return: the compiled query
+    :rtype: SirutaQuery
+
+    :raises ValueError: if the expression is invalid
+
+    """
+    return SirutaQuery(text)
+
+
+"""
+-------------------
+Address extraction
+-------------------
+"""
+
+# the Romanian letters with diacritics, mapped to the folded letters
+_fold_letters = dict((ord(letter), base) for letters, base in (
+    (u"ĂÂăâ", u"A"), (u"Îî", u"I"), (u"ȘŞșş", u"S"), (u"ȚŢțţ", u"T"))
+    for letter in letters)
+
+
+# the characters folded so far, mapped to the folded characters
+_folded_chars = {}
+
+
+def _fold_char(char):
+    """Fold a character: uppercase letters and digits without \
+    diacritics are kept, everything else becomes a space"""
+    folded = _folded_chars.get(char)
+    if folded is None:
+        folded = char.translate(_fold_letters).upper()
+        if len(folded) != 1 or not folded.isalnum():
+            folded = u" "
+        folded = _folded_chars.setdefault(char, folded)
+    return folded
+
+
+def _fold(text):
+    """Fold a name, see :func:`_fold_char`, with single spaces between \
+    words"""
+    return u" ".join(u"".join(_fold_char(char) for char in text).split())
+
+
+class SirutaExtractor(object):
+    """
+    Find the entities mentioned in free-text addresses, e.g.
+    ``"str. Morii nr. 3, sat Valea Mare, com. Priboieni, jud. Argeș"``.
+
+    All the names (without their prefix) are folded, i.e. uppercased
+    with the diacritics and punctuation removed, and compiled into an
+    Aho-Corasick automaton, so each text is scanned in a single pass
+    whatever the number of names. Only whole words match, and of
+    overlapping matches the longest is kept.
+
+    A name can belong to several entities. For each mention, the entity
+    kept is the one related (as a superior or inferior entity) to the
+    largest number of other mentions, with a bonus if the word before
+    the mention gives its type (``jud.``, ``com.``, ``sat``...).
+
+    The automaton is built once per database. Since building it takes a
+    while, it can be stored in a cache file along with the folded names
+    and their codes. The file is used as long as the hash of the codes
+    and names in the database does not change.
+
+    :param database: the database to take the names from
+    :type database: SirutaDatabase
+    :param cache: the file the automaton is read from or written to
+    :type cache: string
+
+    """
+    _cache_version = 2
+
+    # the words announcing the type of the next entity
+    _markers = {
+        u"JUD":        (40,),
+        u"JUDETUL":    (40,),
+        u"MUN":        (1, 4),
+        u"MUNICIPIUL": (1, 4),
+        u"ORAS":       (2, 5),
+        u"ORASUL":     (2, 5),
+        u"COM":        (3,),
+        u"COMUNA":     (3,),
+        u"SAT":        (11, 19, 22, 23),
+        u"SATUL":      (11, 19, 22, 23),
+    }
+
+    def __init__(self, database, cache=None):
+        self._db = database
+        self._lineages = {}
+        digest = self.__digest() if cache is not None else None
+        if cache is None or not self.__read_cache(cache, digest):
+            self.__fold_names()
+            self.__build()
+            if cache is not None:
+                self.__write_cache(cache, digest)
+
+    def __digest(self):
+        """Hash the codes and names of the database"""
+        digest = hashlib.sha256()
+        for code, entry in self._db._data.items():
+            digest.update((u"%d;%s\n" % (code, entry['name'])).encode('utf-8'))
+        return digest.hexdigest()
+
+    def __fold_names(self):
+        """Fold the names without their prefix into the patterns, each \
+        with the codes of the entities having that name"""
+        database = self._db
+        names = collections.defaultdict(list)
+        for code in database._data:
+            name = database._data[code]['name']
+            for prefix in database._prefixes:
+                if name.startswith(prefix):
+                    name = name[len(prefix):]
+            name = _fold(name)
+            if name:
+                names[name].append(code)
+        self._patterns = sorted(names)
+        self._codes = [names[pattern] for pattern in self._patterns]
+
+    def __build(self):
+        """Build the trie of the patterns, then the failure links and \
+        outputs, in breadth-first order"""
+        goto = [{}]
+        output = [[]]
+        for index, pattern in enumerate(self._patterns):
+            state = 0
+            for char in pattern:
+                if char not in goto[state]:
+                    goto[state][char] = len(goto)
+                    goto.append({})
+                    output.append([])
+                state = goto[state][char]
+            output[state].append(index)
+        fail = [0] * len(goto)
+        queue = collections.deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in goto[state].items():
+                queue.append(child)
+                if state:
+                    link = fail[state]
+                    while link and char not in goto[link]:
+                        link = fail[link]
+                    fail[child] = goto[link].get(char, 0)
+                output[child] = output[child] + output[fail[child]]
+        self._goto = goto
+        self._fail = fail
+        self._output = output
+
+    def __read_cache(self, cache, digest):
+        """Load the patterns and the automaton from a cache file, if it \
+        was built from a database with the same hash"""
+        try:
+            with io.open(cache, encoding='utf-8') as fp:
+                stored = json.load(fp)
+        except (IOError, OSError, ValueError):
+            return False
+        if stored.get('version') != self._cache_version or \
+           stored.get('digest') != digest:
+            return False
+        self._patterns = stored['patterns']
+        self._codes = stored['codes']
+        self._goto = stored['goto']
+        self._fail = stored['fail']
+        self._output = stored['output']
+        return True
+
+    def __write_cache(self, cache, digest):
+        with io.open(cache, 'w', encoding='utf-8') as fp:
+            fp.write(json.dumps({
+                'version':  self._cache_version,
+                'digest':   digest,
+                'patterns': self._patterns,
+                'codes':    self._codes,
+                'goto':     self._goto,
+                'fail':     self._fail,
+                'output':   self._output,
+            }, ensure_ascii=False))
+
+    def __lineage(self, code):
+        """Get the set of a code and the codes of all its superiors"""
+        lineage = self._lineages.get(code)
+        if lineage is None:
+            lineage = set()
+            data = self._db._data
+            current = code
+            while current in data and current not in lineage:
+                lineage.add(current)
+                current = data[current]['sirutasup']
+            self._lineages[code] = lineage
+        return lineage
+
+    def __scan(self, text):
+        """
+        Run the automaton over the folded text.
+
+        :return: the folded characters, their positions in the text and \
+        the whole-word matches as ``(start, end, pattern)`` tuples, in \
+        folded positions
+
+        """
+        goto, fail, output = self._goto, self._fail, self._output
+        folded = []
+        positions = []
+        matches = []
+        state = 0
+        previous = u" "
+        for position, char in enumerate(text):
+            char = _fold_char(char)
+            if char == u" " and previous == u" ":
+                continue
+            folded.append(char)
+            positions.append(position)
+            previous = char
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for pattern in output[state]:
+                end = len(folded)
+                matches.append((end - len(self._patterns[pattern]), end, pattern))
+        words = [(start, end, pattern) for start, end, pattern in matches
+                 if start == 0 or folded[start - 1] == u" "
+                 if end == len(folded) or folded[end] == u" "]
+        return folded, positions, words
+
+    def extract(self, text):
+        """
+        Find the entities mentioned in a text
+
+        :param text: the text, e.g. an address
+        :type text: string
+
+        :return: one dictionary per mention, in the order of the text, \
+        with the ``start`` and ``end`` of the mention in the text, its \
+        ``text``, the ``siruta`` code of the entity or ``None`` if the \
+        mention is still ambiguous, and the ``candidates`` left
+        :rtype: list
+
+        """
+        folded, positions, matches = self.__scan(text)
+        matches.sort(key=lambda match: (match[0] - match[1], match[0]))
+        taken = []
+        for start, end, pattern in matches:
+            if all(end <= other[0] or start >= other[1] for other in taken):
+                taken.append((start, end, pattern))
+        taken.sort()
+
+        mentions = []
+        for start, end, pattern in taken:
+            before = u"".join(folded[:max(start - 1, 0)]).rsplit(u" ", 1)[-1]
+            candidates = self._codes[pattern]
+            mentions.append((start, end, candidates,
+                             self._markers.get(before, ()),
+                             set(candidates),
+                             set().union(*[self.__lineage(code) for code in candidates])))
+
+        ret = []
+        data = self._db._data
+        for index, (start, end, candidates, marker, _, _) in enumerate(mentions):
+            others = mentions[:index] + mentions[index + 1:]
+            scores = []
+            for code in candidates:
+                lineage = self.__lineage(code)
+                score = sum(1 for other in others
+                            if code in other[5] or lineage & other[4])
+                if data[code]['type'] in marker:
+                    score += 2
+                scores.append(score)
+            best = max(scores)
+            chosen = sorted(code for code, score in zip(candidates, scores)
+                            if score == best)
+            text_start = positions[start]
+            text_end = positions[end - 1] + 1
+            ret.append({
+                'start':      text_start,
+                'end':        text_end,
+                'text':       text[text_start:text_end],
+                'siruta':     chosen[0] if len(chosen) == 1 else None,
+                'candidates': chosen,
+            })
+        return ret
+
+
+"""
+-----------------
+Siruta History
+-----------------
+"""
+
+
+class _DeltaRows(Mapping):
+    """
+    Read-only mapping over a base ``_data`` mapping with the cumulated
+    changes of later releases applied on top. Unchanged entities are
+    shared with the base.
+
+    """
+    def __init__(self, base, changes, removed):
+        self._base = base
+        self._changes = changes
+        self._removed = removed
+        self._keys = None
+
+    def __getitem__(self, siruta):
+        if siruta in self._changes:
+            return self._changes[siruta]
+        if siruta in self._removed:
+            raise KeyError(siruta)
+        return self._base[siruta]
+
+    def __contains__(self, siruta):
+        if siruta in self._changes:
+            return True
+        return siruta not in self._removed and siruta in self._base
+
+    def __iter__(self):
+        if self._keys is None:
+            keys = [code for code in self._base if code not in self._removed]
+            keys.extend(code for code in self._changes if code not in self._base)
+            self._keys = keys
+        return iter(self._keys)
+
+    def __len__(self):
+        if self._keys is None:
+            iter(self)
+        return len(self._keys)
+
+
+class SirutaHistory:
+    """
+    Several SIRUTA releases, stored as a full base release and one
+    delta per later release, holding only the entities that were added,
+    changed or removed.
+
+    :param releases: list of ``(release, filename)`` tuples; release \
+    labels must be comparable, e.g. ISO dates like ``"2021-01-01"``
+    :type releases: list
+    :param enforce_warnings: treat warnings as exceptions
+
+    """
+    def __init__(self, releases, enforce_warnings=False):
+        releases = sorted(releases)
+        if not releases:
+            raise ValueError("At least one release is required")
+        self._enforce_warnings = enforce_warnings
+        release, filename = releases[0]
+        self._base = SirutaDatabase(filename, enforce_warnings)
+        self._releases = [release]
+        self._deltas = [({}, set())]
+        self._views = {}
+        for release, filename in releases[1:]:
+            self.add_release(release, filename)
+
+    def add_release(self, release, filename):
+        """
+        Parse a new release and store its differences from the latest
+        release in the history
+
+        :param release: the release label, newer than all the existing ones
+        :param filename: the CSV file containing the release
+
+        """
+        if release <= self._releases[-1]:
+            raise ValueError("Release %s is not newer than %s" %
+                             (release, self._releases[-1]))
+        previous = self.as_of(self._releases[-1])._data
+        current = SirutaDatabase(filename, self._enforce_warnings)._data
+        changes = {}
+        for code, entry in current.items():
+            if code not in previous or previous[code] != entry:
+                changes[code] = entry
+        removed = set(code for code in previous if code not in current)
+        self._releases.append(release)
+        self._deltas.append((changes, removed))
+
+    def get_releases(self):
+        """Get the labels of all the stored releases, oldest first"""
+        return list(self._releases)
+
+    def as_of(self, release):
+        """
+        Get the database as it was in the given release. If there is no
+        release with this label, the latest release before it is used,
+        so dates can be passed directly.
+
+        :param release: the release label or date
+
+        :return: a new read-only database view sharing the unchanged \
+        entities with the other releases, or ``None`` if ``release`` \
+        is older than the first stored release
+        :rtype: SirutaDatabase
+
+        """
+        index = bisect.bisect_right(self._releases, release) - 1
+        if index < 0:
+            return None
+        release = self._releases[index]
+        if release not in self._views:
+            changes = {}
+            removed = set()
+            for delta_changes, delta_removed in self._deltas[1:index + 1]:
+                for code in delta_removed:
+                    changes.pop(code, None)
+                    removed.add(code)
+                for code, entry in delta_changes.items():
+                    removed.discard(code)
+                    changes[code] = entry
+            self._views[release] = self._base._view(
+                _DeltaRows(self._base._data, changes, removed))
+        # each caller gets its own view, e.g. for the diacritics settings
+        return self._views[release]._view()
+
+    def get_versions(self, siruta):
+        """
+        Get every version of an entity across the stored releases
+
+        :param siruta: the SIRUTA code
+        :type siruta: int
+
+        :return: a list of ``(release, entity)`` tuples, one for each \
+        release where the entity was added, changed or removed; \
+        ``entity`` is a copy of the row, ``None`` for removals
+        :rtype: list
+
+        """
+        ret = []
+        if siruta in self._base._data:
+            ret.append((self._releases[0], dict(self._base._data[siruta])))
+        for release, (changes, removed) in zip(self._releases[1:],
+                                               self._deltas[1:]):
+            if siruta in changes:
+                ret.append((release, dict(changes[siruta])))
+            elif siruta in removed:
+                ret.append((release, None))
+        return ret
+
+
+"""
+--------------
+Shared memory
+--------------
+"""
+
+
+class SirutaSharedMemory:
+    """
+    Publish a database in a ``multiprocessing.shared_memory`` block, so
+    that worker processes can attach to it by name with
+    :func:`attach_shared_database` instead of parsing the CSV file or
+    receiving a pickled copy. The block is owned by this object: call
+    :meth:`close` (or use it as a context manager) in the parent once the
+    workers are done.
+
+    :param database: the database to publish
+    :type database: SirutaDatabase
+    :param name: the name of the shared memory block, a random one is \
+    chosen by default
+
+    """
+    def __init__(self, database, name=None):
+        from multiprocessing import shared_memory
+        data = _pack_columns(database._columns(), database._prefixes)
+        self._shm = shared_memory.SharedMemory(name=name, create=True,
+                                               size=len(data))
+        self._shm.buf[:len(data)] = data
+        self.name = self._shm.name
+
+    def close(self):
+        """Release and destroy the shared memory block"""
+        if self._shm is not None:
+            self._shm.close()
+            try:
+                self._shm.unlink()
+            except FileNotFoundError:
+                pass  # already destroyed, e.g. by the resource tracker
+            self._shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def attach_shared_database(name, enforce_warnings=False, track=None):
+    """
+    Attach to a database published with :class:`SirutaSharedMemory`.
+    The columns are read directly from the shared block, without copying
+    or parsing anything.
+
+    The block is registered with the resource tracker by its owner. The
+    processes started by the owner with :mod:`multiprocessing` share
+    its tracker and keep the default. A process started independently
+    has its own tracker, which destroys the blocks registered with it
+    when the process exits; on Python 3.12 and older, such processes
+    must pass ``track=False`` so that the block is unregistered.
+
+    :param name: the name of the shared memory block
+    :type name: string
+    :param enforce_warnings: treat warnings as exceptions
+    :param track: ``False`` if the process does not share the resource \
+    tracker of the owner
+    :type track: bool
+
+    :return: a read-only database, to be released with \
+    :func:`detach_shared_database`
+    :rtype: SirutaDatabase
+
+    """
+    from multiprocessing import shared_memory
+    try:
+        shm = shared_memory.SharedMemory(name=name, track=bool(track))
+    except TypeError:
+        # before Python 3.13 attaching always registers the block; with
+        # the owner's tracker this is a no-op, but unregistering would
+        # also drop the owner's registration
+        shm = shared_memory.SharedMemory(name=name)
+        if track is False:
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name, "shared_memory")
+    columns = _unpack_columns(shm.buf)
+    index = columns.pop('_index')
+    db = SirutaDatabase._from_data(_ColumnarRows(columns, index=index),
+                                   enforce_warnings)
+    # the mapping must outlive every view over its buffer
+    db._shared = shm
+    return db
+
+
+def detach_shared_database(database):
+    """
+    Release the shared memory block of a database returned by
+    :func:`attach_shared_database`. The block itself is left to its
+    owner. The database and all its views are empty afterwards.
+
+    :param database: the attached database
+    :type database: SirutaDatabase
+
+    """
+    shm = getattr(database, '_shared', None)
+    if shm is None:
+        return
+    database._data.clear()
+    database._indexes.clear()
+    database._query_cache = None
+    database._shared = None
+    shm.close()
+
+
+"""
+-------------------
+Comparing extracts
+-------------------
+"""
+
+
+def _diff_fields(codes, old_rows, new_rows):
+    """
+    Compare the rows of the entities in both extracts, field by field
+
+    :return: a dictionary of field name to a list of ``(code, old \
+    value, new value)`` tuples
+    :rtype: dict
+
+    """
+    fields = SirutaDatabase._fields
+    changed = dict((field, []) for field in fields[1:])
+    for code in codes:
+        old_row = old_rows.get(code)
+        new_row = new_rows[code]
+        if old_row is None or old_row == new_row:
+            continue
+        for index in range(1, len(fields)):
+            if old_row[index] != new_row[index]:
+                changed[fields[index]].append(
+                    (code, old_row[index], new_row[index]))
+    return changed
+
+
+def diff(old, new):
+    """
+    Compare two SIRUTA extracts.
+
+    The entities are compared as tuples built from the columnar
+    representation of each database, so the comparison is a couple of
+    hash lookups per entity.
+
+    :param old: the old extract, as a database or a CSV file name
+    :type old: SirutaDatabase or string
+    :param new: the new extract, as a database or a CSV file name
+    :type new: SirutaDatabase or string
+
+    :return: a dictionary with the ``added`` and ``removed`` codes, the \
+    ``changed`` fields as a dictionary of field name to a list of \
+    ``(code, old value, new value)`` tuples and the ``moved`` subtrees, \
+    one dictionary per entity with a new superior code, also listing \
+    all the descendants that moved with it, or ``None`` if not all the \
+    fields were loaded in one of the databases
+    :rtype: dict
+
+    """
+    if not isinstance(old, SirutaDatabase):
+        old = SirutaDatabase(old)
+    if not isinstance(new, SirutaDatabase):
+        new = SirutaDatabase(new)
+    fields = SirutaDatabase._fields
+    if not old._has_fields(fields) or not new._has_fields(fields):
+        return None
+    old_columns = old._columns()
+    new_columns = new._columns()
+    old_rows = dict(zip(old_columns['siruta'],
+                        zip(*[old_columns[field] for field in fields])))
+    new_rows = dict(zip(new_columns['siruta'],
+                        zip(*[new_columns[field] for field in fields])))
+
+    ret = {
+        'added':   [code for code in new_columns['siruta'] if code not in old_rows],
+        'removed': [code for code in old_columns['siruta'] if code not in new_rows],
+        'changed': _diff_fields(new_columns['siruta'], old_rows, new_rows),
+        'moved':   [],
+    }
+
+    children = collections.defaultdict(list)
+    for code, sup in zip(new_columns['siruta'], new_columns['sirutasup']):
+        children[sup].append(code)
+    for code, old_sup, new_sup in ret['changed']['sirutasup']:
+        # the superior codes may loop, so every code is only visited once
+        seen = set([code])
+        pending = list(children.get(code, []))
+        while pending:
+            child = pending.pop()
+            if child not in seen:
+                seen.add(child)
+                pending.extend(children.get(child, []))
+        descendants = seen - set([code])
+        ret['moved'].append({'siruta': code, 'from': old_sup, 'to': new_sup,
+                             'descendants': sorted(descendants)})
+    return ret
+
+
+"""
+-------------------
+Comparing backends
+-------------------
+"""
+
+# the methods that can appear in a workload; none of them changes the database
+_workload_methods = (
+    'get_name', 'get_sup_code', 'get_sup_name', 'get_postal_code',
+    'get_type', 'get_type_string', 'get_county', 'get_county_string',
+    'get_county_name', 'get_region', 'get_region_string', 'get_inf_codes',
+    'get_label', 'get_labels', 'get_entity', 'get_siruta_list',
+    'get_siruta_page', 'get_codes_by_postcode', 'get_codes_by_postcode_range',
+    'get_codes_by_postcode_prefix', 'get_all_counties', 'select',
+    'suggest_codes', 'count_by', 'rollup', 'count_subtree', 'siruta_is_valid',
+)
+
+# the arguments of ``set_diacritics_params``, ``None`` being the default
+_diacritics_modes = [None] + [(cedilla, acircumflex, nodia)
+                              for cedilla in (False, True)
+                              for acircumflex in (True, False)
+                              for nodia in (False, True)]
+
+
+def generate_workload(database, samples=50, seed=0):
+    """
+    Generate a workload for :func:`compare_databases`: every getter,
+    with every combination of its options, for a random sample of
+    codes (plus the counties and a code that is not in the database),
+    and ``get_siruta_list`` with every combination of filters built
+    from the sampled entities.
+
+    :param database: the database to take the codes from
+    :type database: SirutaDatabase
+    :param samples: the number of codes to sample
+    :type samples: int
+    :param seed: the seed of the random sample
+    :type seed: int
+
+    :return: a list of ``(method, args, kwargs)`` tuples, empty if not \
+    all the fields were loaded
+    :rtype: list
+
+    """
+    if not database._has_fields(SirutaDatabase._fields):
+        return []
+    rng = random.Random(seed)
+    codes = sorted(database._data)
+    sample = rng.sample(codes, min(samples, len(codes)))
+    sample.extend(code for code in codes if database._data[code]['type'] == 40)
+    workload = []
+    for code in sample + [1]:
+        workload.extend(_getter_calls(code))
+    entries = [database._data[code] for code in sample[:max(1, samples // 10)]]
+    for entry in entries:
+        workload.extend(_list_calls(entry, database._data[rng.choice(codes)]))
+    return workload
+
+
+def _getter_calls(code):
+    """The calls of every getter for one code, with all their options"""
+    calls = []
+    for method in ('get_sup_code', 'get_type', 'get_type_string',
+                   'get_county', 'get_region', 'get_region_string',
+                   'get_inf_codes', 'get_entity'):
+        calls.append((method, [code], {}))
+    for method in ('get_name', 'get_sup_name', 'get_county_string'):
+        for prefix in (True, False):
+            calls.append((method, [code], {'prefix': prefix}))
+    for resolve in (False, True):
+        calls.append(('get_postal_code', [code], {'resolve': resolve}))
+    for style in ('full', 'short'):
+        calls.append(('get_label', [code], {'style': style}))
+    return calls
+
+
+def _list_calls(entry, other):
+    """The calls of ``get_siruta_list`` with every combination of \
+    filters built from an entity and another one"""
+    names = [None, entry['name'], entry['name'].split(' ')[-1]]
+    return [('get_siruta_list', [county_list, type_list, name, add_prefix], {})
+            for county_list in (None, [entry['county']],
+                                [entry['county'], other['county']])
+            for type_list in (None, [entry['type']], [entry['type'], other['type']])
+            for name in names
+            for add_prefix in (False, True)]
+
+
+def read_workload(fp):
+    """
+    Read a recorded workload, one JSON object per line with the
+    ``method`` and optionally the ``args`` and ``kwargs`` of a call
+
+    :param fp: the file to read
+    :type fp: file
+
+    :return: a list of ``(method, args, kwargs)`` tuples
+    :rtype: list
+
+    """
+    workload = []
+    for line in fp:
+        if not line.strip():
+            continue
+        call = json.loads(line)
+        if call.get('method') not in _workload_methods:
+            raise ValueError("Unknown method in workload: %r" % call.get('method'))
+        workload.append((call['method'], call.get('args', []), call.get('kwargs', {})))
+    return workload
+
+
+def write_workload(workload, fp):
+    """
+    Write a workload in the format read by :func:`read_workload`
+
+    :param workload: a list of ``(method, args, kwargs)`` tuples
+    :type workload: list
+    :param fp: the file to write to
+    :type fp: file
+
+    """
+    for method, args, kwargs in workload:
+        fp.write(json.dumps({'method': method, 'args': list(args),
+                             'kwargs': kwargs}, ensure_ascii=False))
+        fp.write(u"\n")
+
+
+def _normalize_result(value):
+    """Convert a result to plain lists and dictionaries, so that \
+    equivalent results from different backends compare equal"""
+    if isinstance(value, SirutaSet):
+        return value.to_list()
+    if isinstance(value, SirutaEntity):
+        return dict((attribute, getattr(value, attribute)) for attribute in (
+            'siruta', 'sup_code', 'postal_code', 'type', 'level', 'urban',
+            'county', 'region', 'name', 'short_name', 'type_string',
+            'county_name', 'region_name'))
+    if isinstance(value, (list, tuple)):
+        return [_normalize_result(item) for item in value]
+    if isinstance(value, dict):
+        return dict((key, _normalize_result(item)) for key, item in value.items())
+    return value
+
+
+def _run_call(database, method, args, kwargs, tracemalloc=None):
+    """
+    Run one call of a workload.
+
+    :return: the normalized result (or the name of the exception \
+    raised), the last error, the duration and the peak memory \
+    allocated, if ``tracemalloc`` is given
+
+    """
+    database._last_error = ""
+    if tracemalloc is not None:
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+    start = timeit.default_timer()
+    try:
+        result = getattr(database, method)(*args, **kwargs)
+    except Exception as e:
+        result = ('exception', type(e).__name__)
+    duration = timeit.default_timer() - start
+    memory = 0
+    if tracemalloc is not None:
+        memory = tracemalloc.get_traced_memory()[1] - before
+    return _normalize_result(result), database._last_error, duration, memory
+
+
+def compare_databases(reference, candidate, workload=None, modes=None,
+                      budgets=None):
+    """
+    Replay a workload against a reference database and a candidate one,
+    e.g. a compacted or memory-mapped copy, in every diacritics mode.
+    The results and the last errors must be identical; the candidate's
+    calls can also be checked against latency and memory budgets.
+
+    :param reference: the database giving the expected results
+    :type reference: SirutaDatabase
+    :param candidate: the database being checked
+    :type candidate: SirutaDatabase
+    :param workload: a list of ``(method, args, kwargs)`` tuples; by \
+    default one is built with :func:`generate_workload`
+    :type workload: list
+    :param modes: the arguments of ``set_diacritics_params`` to use, \
+    ``None`` standing for the default mode; by default all of them
+    :type modes: list
+    :param budgets: a dictionary of method name (or ``*`` for all the \
+    methods) to a dictionary of limits: ``latency`` for the mean \
+    duration of a call, in seconds, ``slowdown`` for the ratio to the \
+    mean duration of the reference and ``memory`` for the peak memory \
+    allocated by a call, in bytes
+    :type budgets: dict
+
+    :return: a dictionary with the number of ``calls``, the \
+    ``mismatches``, the statistics of each method in ``operations`` \
+    and the exceeded budgets in ``violations``
+    :rtype: dict
+
+    """
+    if workload is None:
+        workload = generate_workload(reference)
+    if modes is None:
+        modes = _diacritics_modes
+    budgets = budgets or {}
+    tracemalloc = None
+    if any('memory' in limits for limits in budgets.values()):
+        tracemalloc = _require("tracemalloc")
+
+    report = {'calls': 0, 'mismatches': [], 'operations': {}, 'violations': []}
+    saved = (reference._dia, candidate._dia)
+    if tracemalloc is not None:
+        tracemalloc.start()
+    try:
+        for mode in modes:
+            for database in (reference, candidate):
+                if mode is None:
+                    database.reset_diacritics_params()
+                else:
+                    database.set_diacritics_params(*mode)
+            for call in workload:
+                _compare_call(report, reference, candidate, call, mode,
+                              tracemalloc)
+    finally:
+        if tracemalloc is not None:
+            tracemalloc.stop()
+        reference._dia, candidate._dia = saved
+    report['violations'] = _check_budgets(report['operations'], budgets)
+    return report
+
+
+def _compare_call(report, reference, candidate, call, mode, tracemalloc):
+    """Run one call on both databases and add it to the report"""
+    method, args, kwargs = call
+    expected, expected_error, reference_time, _ = _run_call(
+        reference, method, args, kwargs)
+    actual, actual_error, candidate_time, memory = _run_call(
+        candidate, method, args, kwargs, tracemalloc)
+    report['calls'] += 1
+    stats = report['operations'].setdefault(method, {
+        'calls': 0, 'reference_time': 0.0, 'candidate_time': 0.0,
+        'candidate_memory': 0})
+    stats['calls'] += 1
+    stats['reference_time'] += reference_time
+    stats['candidate_time'] += candidate_time
+    stats['candidate_memory'] = max(stats['candidate_memory'], memory)
+    if expected != actual or expected_error != actual_error:
+        report['mismatches'].append({
+            'call': [method, list(args), kwargs],
+            'diacritics': mode,
+            'reference': [expected, expected_error],
+            'candidate': [actual, actual_error],
+        })
+
+
+def _check_budgets(operations, budgets):
+    """Get the budgets exceeded by the candidate, per method"""
+    violations = []
+    for method, stats in sorted(operations.items()):
+        limits = budgets.get(method, budgets.get('*', {}))
+        values = {
+            'latency':  stats['candidate_time'] / stats['calls'],
+            'slowdown': stats['candidate_time'] / max(stats['reference_time'], 1e-9),
+            'memory':   stats['candidate_memory'],
+        }
+        for budget in ('latency', 'slowdown', 'memory'):
+            if budget in limits and values[budget] > limits[budget]:
+                violations.append({'method': method, 'budget': budget,
+                                   'limit': limits[budget],
+                                   'value': values[budget]})
+    return violations
+
+
+"""
+--------------------
+Validating extracts
+--------------------
+"""
+
+
+def _check_checksums(extract, codes, known):
+    """Get the codes with an invalid check digit, split between the \
+    unknown and the known ones"""
+    unknown, found = [], []
+    for code in codes:
+        if not extract.siruta_is_valid(code):
+            (found if code in known else unknown).append(code)
+    return unknown, found
+
+
+def _check_types(extract, columns):
+    """Get the entities with an unknown type or a level that does not \
+    match their type"""
+    invalid_type, invalid_level = [], []
+    for code, type_, level in zip(columns['siruta'], columns['type'],
+                                  columns['level']):
+        if type_ not in extract._village_type:
+            invalid_type.append((code, type_))
+        elif level not in extract._type_levels.get(type_, (level,)):
+            invalid_level.append((code, type_, level))
+    return invalid_type, invalid_level
+
+
+def _check_parents(extract, columns, parents):
+    """Get the entities without a superior entity, in another county \
+    than their superior entity or that cannot belong to it"""
+    counties = dict(zip(columns['siruta'], columns['county']))
+    types = dict(zip(columns['siruta'], columns['type']))
+    missing, mismatch, invalid = [], [], []
+    for code, parent, county, type_ in zip(
+            columns['siruta'], columns['sirutasup'], columns['county'],
+            columns['type']):
+        if parent not in parents:
+            if type_ != 40:
+                missing.append(code)
+            continue
+        if counties[parent] != county:
+            mismatch.append((code, county, counties[parent]))
+        if type_ in extract._parent_types and \
+           types[parent] not in extract._parent_types[type_]:
+            invalid.append((code, type_, types[parent]))
+    return missing, mismatch, invalid
+
+
+def _find_cycles(codes, parents):
+    """
+    Find the chains of superior codes that loop. Each walk stops at the
+    first entity already visited, so every entity is visited once; a
+    walk meeting itself found a cycle.
+
+    """
+    cycles = []
+    walks = {}
+    for code in codes:
+        path = []
+        current = code
+        while current in parents and current not in walks:
+            walks[current] = code
+            path.append(current)
+            current = parents[current]
+        if walks.get(current) == code:
+            cycles.append(path[path.index(current):])
+    return cycles
+
+
+def validate(extract, known_checksum_failures=None):
+    """
+    Check the consistency of a SIRUTA extract, e.g. before deploying
+    it. Each group of rules is checked in one pass over the columns,
+    and the cycles in one walk up the hierarchy that visits each entity
+    once:
+
+    * ``rows``: the rows rejected or overwritten while parsing the file
+    * ``checksum``: the codes with an invalid check digit, except the \
+    known ones
+    * ``missing_parent``: the codes whose superior code is not in the \
+    extract (only allowed for counties)
+    * ``cycles``: the chains of superior codes that loop, as lists of \
+    codes
+    * ``county_mismatch``: ``(code, county, superior county)`` for the \
+    entities in another county than their superior entity
+    * ``invalid_type``: ``(code, type)`` for unknown types
+    * ``invalid_level``: ``(code, type, level)`` for levels that do \
+    not match the type
+    * ``invalid_parent_type``: ``(code, type, superior type)`` for \
+    entities that cannot belong to their superior entity
+
+    :param extract: the extract, as a database or a CSV file name
+    :type extract: SirutaDatabase or string
+    :param known_checksum_failures: the codes with an invalid check \
+    digit that are accepted, e.g. those of the previous extract
+    :type known_checksum_failures: list, set or SirutaDatabase
+
+    :return: a dictionary with the number of ``entities``, the \
+    ``errors`` as a dictionary of rule to list of problems, the \
+    ``known_checksum`` failures found and whether the extract is \
+    ``valid``, i.e. has no errors, or ``None`` if the superior codes, \
+    counties, types or levels were not loaded
+    :rtype: dict
+
+    """
+    if not isinstance(extract, SirutaDatabase):
+        extract = SirutaDatabase(extract)
+    if not extract._has_fields(['sirutasup', 'county', 'type', 'level']):
+        return None
+    if isinstance(known_checksum_failures, SirutaDatabase):
+        known_checksum_failures = [code for code in known_checksum_failures._data
+                                   if not known_checksum_failures.siruta_is_valid(code)]
+    known = set(known_checksum_failures or [])
+    columns = extract._columns()
+    codes = columns['siruta']
+    parents = dict(zip(codes, columns['sirutasup']))
+
+    checksum, known_failures = _check_checksums(extract, codes, known)
+    invalid_type, invalid_level = _check_types(extract, columns)
+    missing_parent, county_mismatch, invalid_parent_type = \
+        _check_parents(extract, columns, parents)
+    errors = {
+        'rows':                list(extract._rejected_rows),
+        'checksum':            checksum,
+        'missing_parent':      missing_parent,
+        'cycles':              _find_cycles(codes, parents),
+        'county_mismatch':     county_mismatch,
+        'invalid_type':        invalid_type,
+        'invalid_level':       invalid_level,
+        'invalid_parent_type': invalid_parent_type,
+    }
+    return {
+        'entities': len(codes),
+        'errors': errors,
+        'known_checksum': known_failures,
+        'valid': not any(errors.values()),
+    }
+
+
+"""
+-------------------------
+Shared default database
+-------------------------
+"""
+
+_default_databases = {}
+# one lock per combination of options, so building a database does not
+# block the callers asking for another one
+_default_databases_locks = {}
+_default_databases_lock = threading.Lock()
+
+
+def get_default_database(filename="siruta.csv", enforce_warnings=False,
+                         counties=None, regions=None, fields=None):
+    """
+    Get a database shared by the whole process. The database is built
+    on first use, once for every combination of file and options, and
+    every call returns a new lightweight view of it, so each caller can
+    change the diacritics settings and the query cache independently.
+    The views share the data and the indexes and must not be modified.
+
+    The parameters are the same as for :class:`SirutaDatabase`.
+
+    :return: a view of the shared database
+    :rtype: SirutaDatabase
+
+    """
+    if any(value is not None and type(value) is not list
+           for value in (counties, regions, fields)):
+        # let the constructor report the invalid argument
+        return SirutaDatabase(filename, enforce_warnings, counties, regions,
+                              fields)
+    key = (SirutaDatabase._find_file(filename) or filename, enforce_warnings,
+           tuple(sorted(counties)) if type(counties) is list else counties,
+           tuple(sorted(regions)) if type(regions) is list else regions,
+           tuple(sorted(fields)) if type(fields) is list else fields)
+    with _default_databases_lock:
+        lock = _default_databases_locks.setdefault(key, threading.Lock())
+    with lock:
+        if key not in _default_databases:
+            _default_databases[key] = SirutaDatabase(filename, enforce_warnings,
+                                                     counties, regions, fields)
+        database = _default_databases[key]
+    view = database._view()
+    view.reset_diacritics_params()
+    return view
+
+
+"""
+----------------
+pandas support
+----------------
+"""
+
+
+class SirutaAccessor(object):
+    """
+    pandas DataFrame accessor, registered by
+    :func:`register_pandas_accessor`. It joins a column of SIRUTA codes
+    against the database in one vectorized step instead of calling the
+    getters once per row.
+
+    """
+    _string_fields = ['name', 'sup_name', 'type_string', 'county_string',
+                      'county_name', 'region_string', 'region_name']
+
+    def __init__(self, obj):
+        self._obj = obj
+
+    def enrich(self, column, fields=None, prefix=True, diacritics=None,
+               database=None):
+        """
+        Add columns with data about the SIRUTA codes in ``column``.
+        Codes missing from the database produce NA values; name fields
+        are returned as categorical columns.
+
+        :param column: the column containing SIRUTA codes
+        :type column: string
+        :param fields: getter names without the ``get_`` prefix, e.g. \
+        ``['name', 'county_name']``; each one becomes a column
+        :type fields: list
+        :param prefix: True if names should include the entity type
+        :type prefix: bool
+        :param diacritics: keyword arguments for \
+        :meth:`SirutaDatabase.set_diacritics_params`
+        :type diacritics: dict
+        :param database: the database to use, the one returned by \
+        :func:`get_default_database` by default
+
+        :return: a new DataFrame with the added columns or ``None`` if \
+        an invalid field was requested
+        :rtype: pandas.DataFrame
+
+        """
+        pd = _require("pandas")
+        np = _require("numpy")
+        if database is None:
+            database = get_default_database()
+        if fields is None:
+            fields = ['name', 'county_name']
+        lookup = database._lookup_columns(fields, prefix, diacritics)
+        if lookup is None:
+            return None
+        codes, table = lookup
+        positions = pd.Index(codes).get_indexer(self._obj[column])
+        missing = positions < 0
+        new_columns = {}
+        for field in fields:
+            values = table[field]
+            if field in self._string_fields:
+                categories = sorted(set(v for v in values if v is not None))
+                category_codes = dict((v, i) for i, v in enumerate(categories))
+                value_codes = np.array([category_codes.get(v, -1) for v in values],
+                                       dtype=np.int32)
+                row_codes = np.where(missing, -1, value_codes[positions])
+                result = pd.Categorical.from_codes(row_codes, categories)
+            else:
+                result = pd.array(values, dtype="Int64").take(positions,
+                                                              allow_fill=True)
+            new_columns[field] = pd.Series(result, index=self._obj.index)
+        return self._obj.assign(**new_columns)
+
+
+def register_pandas_accessor(name="siruta"):
+    """
+    Register :class:`SirutaAccessor` on pandas DataFrames, making it
+    available as ``df.siruta.enrich(...)``
+
+    :param name: the accessor attribute name
+    :type name: string
+
+    """
+    pd = _require("pandas")
+    pd.api.extensions.register_dataframe_accessor(name)(SirutaAccessor)
+
+
+"""
+-----------------------
+Command line interface
+-----------------------
+"""
+
+
+def main(argv=None):
+    """
+    Command line entry point. Run ``python sirutalib.py --help`` for
+    the available commands.
+
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog="sirutalib")
+    commands = parser.add_subparsers(dest="command")
+    command = commands.add_parser("diff", help="compare two SIRUTA extracts")
+    command.add_argument("old", help="the old CSV file")
+    command.add_argument("new", help="the new CSV file")
+    command = commands.add_parser("validate", help="check the consistency of "
+                                  "a SIRUTA extract")
+    command.add_argument("file", help="the CSV file")
+    command.add_argument("--previous", help="the CSV file of the previous "
+                         "extract, whose checksum failures are accepted")
+    command = commands.add_parser("compare", help="check that another backend "
+                                  "returns the same results as the CSV file")
+    command.add_argument("reference", help="the reference CSV file")
+    command.add_argument("candidate", help="the candidate CSV or Arrow file")
+    command.add_argument("--compact", action="store_true",
+                         help="compact the candidate database")
+    command.add_argument("--workload", help="a recorded workload to replay "
+                         "instead of a generated one")
+    command.add_argument("--budgets", help="a JSON file with the latency and "
+                         "memory budgets of each method")
+    args = parser.parse_args(argv)
+
+    if args.command == "diff":
+        ret = diff(args.old, args.new)
+        json.dump(ret, sys.stdout, ensure_ascii=False, indent=1)
+        sys.stdout.write("\n")
+        return 0
+    if args.command == "validate":
+        previous = SirutaDatabase(args.previous) if args.previous else None
+        ret = validate(args.file, previous)
+        json.dump(ret, sys.stdout, ensure_ascii=False, indent=1)
+        sys.stdout.write("\n")
+        return 0 if ret['valid'] else 1
+    if args.command == "compare":
+        reference = SirutaDatabase(args.reference)
+        candidate = SirutaDatabase(args.candidate)
+        if args.compact:
+            candidate.compact()
+        workload = budgets = None
+        if args.workload:
+            with io.open(args.workload, encoding="utf-8") as fp:
+                workload = read_workload(fp)
+        if args.budgets:
+            with io.open(args.budgets, encoding="utf-8") as fp:
+                budgets = json.load(fp)
+        ret = compare_databases(reference, candidate, workload, budgets=budgets)
+        json.dump(ret, sys.stdout, ensure_ascii=False, indent=1)
+        sys.stdout.write("\n")
+        return 1 if ret['mismatches'] or ret['violations'] else 0
+    parser.print_help()
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -42,7 +42,24 @@ try:
     import unittest2 as unittest
 except ImportError:
     import unittest
+import base64
+import json
 import mmap
+import os
+import shutil
+import tempfile
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+try:
+    import pandas
+except ImportError:
+    pandas = None
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 PY2 = sys.version_info[0] < 3
@@ -93,6 +110,16 @@ county_names = [
 ]
 
 
+def _shared_database_names(args):
+    import sirutalib
+    name, codes = args
+    csv = sirutalib.attach_shared_database(name)
+    try:
+        return [csv.get_name(code) for code in codes]
+    finally:
+        sirutalib.detach_shared_database(csv)
+
+
 class TestSirutaCsv(unittest.TestCase):
     _csv = None
 
@@ -146,6 +173,21 @@ class TestSirutaCsv(unittest.TestCase):
         # this is an imaginary, wrong SIRUTA code
         self.assertFalse(self._csv.siruta_is_valid(179197))
 
+    def test_suggest_codes(self):
+        # swapped digits
+        self.assertEqual(self._csv.suggest_codes(143405)[0], 143450)
+        self.assertEqual(self._csv.suggest_codes("179114", limit=1), [179141])
+        # missing and extra digits
+        self.assertEqual(self._csv.suggest_codes(14345, county_hint=32)[0], 143450)
+        self.assertEqual(self._csv.suggest_codes(1434500, max_distance=1), [143450])
+        for code in self._csv.suggest_codes(143405):
+            self.assertTrue(code in self._csv._data)
+            self.assertTrue(self._csv.siruta_is_valid(code))
+        self.assertEqual(len(self._csv.suggest_codes(143405, limit=3)), 3)
+        self.assertEqual(self._csv.suggest_codes("14x"), [])
+        self.assertEqual(self._csv.suggest_codes(u"14\u00b2"), [])
+        self.assertEqual(self._csv.suggest_codes(143405, max_distance=3), [])
+
     def test_get_last_error(self):
         invalid_siruta = 179197
         self._csv.get_region(invalid_siruta)
@@ -172,6 +214,22 @@ class TestSirutaCsv(unittest.TestCase):
         self.assertEqual(self._csv.get_postal_code(1035), 510001)
         # this is an imaginary, wrong SIRUTA code
         self.assertEqual(self._csv.get_postal_code(179197), None)
+        self.assertEqual(self._csv.get_postal_code(1035, resolve=True), 510001)
+        self.assertEqual(self._csv.get_postal_code(1017, resolve=True), 510005)
+        self.assertEqual(self._csv.get_postal_code(10, resolve=True), 510005)
+
+    def test_get_codes_by_postcode(self):
+        self.assertEqual(self._csv.get_codes_by_postcode(510001), [1035])
+        self.assertEqual(self._csv.get_codes_by_postcode(0), [])
+        self.assertEqual(self._csv.get_codes_by_postcode(999999), [])
+        codes = self._csv.get_codes_by_postcode_prefix("51")
+        self.assertTrue(1035 in codes and 1026 in codes)
+        for code in codes:
+            self.assertEqual(str(self._csv.get_postal_code(code))[:2], "51")
+        self.assertEqual(self._csv.get_codes_by_postcode_range(510001, 510005),
+                         [1035, 1044, 1053, 1062, 1026])
+        self.assertEqual(self._csv.get_codes_by_postcode_prefix("5x"), [])
+        self.assertEqual(self._csv.get_codes_by_postcode_prefix(u"5\u00b2"), [])
 
     def test_get_type(self):
         self.assertEqual(self._csv.get_type(179132), 9)
@@ -232,6 +290,129 @@ class TestSirutaCsv(unittest.TestCase):
     def test_get_region_by_name(self):
         self.assertRaises(NotImplementedError, self._csv.get_region_by_name, "JUDEȚUL ALBA")
 
+    def test_get_label(self):
+        self.assertEqual(self._csv.get_label(10), u"jud. ALBA")
+        self.assertEqual(self._csv.get_label(1017), u"mun. ALBA IULIA, jud. ALBA")
+        self.assertEqual(self._csv.get_label(18304),
+                         u"VALEA MARE, com. PRIBOIENI, jud. ARGEȘ")
+        self.assertEqual(self._csv.get_label(85993),
+                         u"ȘIMONEȘTI, com. ȘIMONEȘTI, jud. HARGHITA")
+        self.assertEqual(self._csv.get_label(85993, style="short"),
+                         u"ȘIMONEȘTI, jud. HARGHITA")
+        self.assertEqual(self._csv.get_label(179141),
+                         u"BUCUREȘTI SECTORUL 1, mun. BUCUREȘTI")
+        self.assertEqual(self._csv.get_label(179197), None)
+        self.assertEqual(self._csv.get_label(10, style="foo"), None)
+        self.assertEqual(self._csv.get_labels([10, 179197]), [u"jud. ALBA", None])
+        self._csv.set_diacritics_params(nodia=True)
+        try:
+            self.assertEqual(self._csv.get_label(85993),
+                             u"SIMONESTI, com. SIMONESTI, jud. HARGHITA")
+        finally:
+            self._csv.reset_diacritics_params()
+        self.assertEqual(self._csv.get_label(85993),
+                         u"ȘIMONEȘTI, com. ȘIMONEȘTI, jud. HARGHITA")
+
+    def test_get_siruta_page(self):
+        codes, cursor = self._csv.get_siruta_page([12], None, limit=5)
+        self.assertEqual(codes, [56586, 55473, 55482, 55491, 58026])
+        codes, cursor = self._csv.get_siruta_page([12], None, limit=5,
+                                                  cursor=cursor)
+        self.assertEqual(codes, [55598, 55605, 55623, 55632, 59452])
+        self.assertEqual(self._csv.get_siruta_page(None, [40], order="type",
+                                                   limit=3)[0], [10, 29, 38])
+
+        codes, cursor = [], None
+        while True:
+            page, cursor = self._csv.get_siruta_page([32], [3, 23], "code", 7,
+                                                     cursor)
+            self.assertTrue(len(page) <= 7)
+            codes.extend(page)
+            if cursor is None:
+                break
+        self.assertEqual(codes, sorted(self._csv.get_siruta_list([32], [3, 23])))
+        # without filters, the pages are slices of the whole order
+        counties = sorted(set(entry['county'] for entry in self._csv._data.values()))
+        first, cursor = self._csv.get_siruta_page(order="type", limit=500)
+        second = self._csv.get_siruta_page(order="type", limit=500, cursor=cursor)[0]
+        self.assertEqual(first + second,
+                         self._csv.get_siruta_page(counties, order="type", limit=1000)[0])
+
+        self.assertEqual(self._csv.get_siruta_page(order="size"), None)
+        self.assertEqual(self._csv.get_siruta_page(limit=0), None)
+        self.assertEqual(self._csv.get_siruta_page(cursor="abc"), None)
+        self.assertEqual(self._csv.get_last_error(), "Invalid cursor required")
+        for after in ([1, 2], ["A"], ["A", 1, 2], ["A", "1"]):
+            cursor = base64.urlsafe_b64encode(
+                json.dumps(["name", after]).encode('utf-8')).decode('ascii')
+            self._csv._last_error = ""
+            self.assertEqual(self._csv.get_siruta_page(cursor=cursor), None)
+            self.assertEqual(self._csv.get_last_error(), "Invalid cursor required")
+
+    def test_select(self):
+        import sirutalib
+        query = 'region in (7, 8) and not urban and name ~ "valea m*"'
+        expected = sorted(code for code, entry in self._csv._data.items()
+                          if entry['region'] in (7, 8) and not entry['urban']
+                          if entry['name'].startswith(u"VALEA M"))
+        self.assertTrue(len(expected) > 0)
+        self.assertEqual(self._csv.select(query), expected)
+        self.assertEqual(self._csv.select(sirutalib.compile_query(query), as_set=True),
+                         sirutalib.SirutaSet(expected))
+        self.assertTrue(sirutalib.compile_query(query) is sirutalib.compile_query(query))
+        self.assertEqual(self._csv.select('county = 32 and type = 1 or code = 10'),
+                         [10, 143450])
+        self.assertEqual(self._csv.select('postal_code >= 510001 and postal_code <= 510002'),
+                         [1035, 1044])
+        self.assertEqual(self._csv.select('name = "sibiu"'), [143469])
+        self.assertEqual(self._csv.select('foo = 1'), [])
+        self.assertEqual(self._csv.get_last_error(), "Invalid query: Unknown field foo in query")
+        self.assertEqual(self._csv.select('county in (1'), [])
+        self.assertRaises(ValueError, sirutalib.compile_query, 'type = = 1')
+        for query in ('name = 5', 'name in (1, 2)', 'name < 5', 'level = 2',
+                      'county ~ "1*"', 'siruta < "a"', 'county in (1, "a")'):
+            self.assertRaises(ValueError, sirutalib.compile_query, query)
+            self.assertEqual(self._csv.select(query), [])
+            self.assertTrue(self._csv.get_last_error().startswith("Invalid query"))
+        self.assertEqual(self._csv.select('county = 1 and level = "1"'), [10])
+        self.assertEqual(self._csv.select('urban in (1) and siruta < 1030'), [1017, 1026])
+        for field in ('county', 'type', 'region'):
+            self.assertEqual(len(self._csv.select(field)),
+                             sum(1 for entry in self._csv._data.values() if entry[field]))
+            self.assertEqual(len(self._csv.select('not ' + field)),
+                             sum(1 for entry in self._csv._data.values() if not entry[field]))
+        self.assertEqual(self._csv.select(None), [])
+        self.assertEqual(self._csv.get_last_error(), "Invalid query required")
+
+    def test_get_entity(self):
+        entity = self._csv.get_entity(1017)
+        self.assertEqual(entity.siruta, 1017)
+        self.assertEqual(entity.name, u"MUNICIPIUL ALBA IULIA")
+        self.assertEqual(entity.short_name, u"ALBA IULIA")
+        self.assertEqual(entity.sup_code, 10)
+        self.assertEqual(entity.postal_code, 0)
+        self.assertEqual(entity.type, 1)
+        self.assertEqual(entity.type_string, self._csv.get_type_string(1017))
+        self.assertEqual(entity.county_name, u"JUDEȚUL ALBA")
+        self.assertEqual(entity.region_name, u"Centru")
+        self.assertTrue(entity.urban)
+        self.assertRaises(AttributeError, setattr, entity, "type", 2)
+        self.assertEqual(self._csv.get_entity(179197), None)
+        self._csv.set_diacritics_params(cedilla=True)
+        try:
+            self.assertEqual(self._csv.get_entity(86453).county_name, u"JUDEŢUL HARGHITA")
+        finally:
+            self._csv.reset_diacritics_params()
+
+    def test_iter_entities(self):
+        entities = list(self._csv.iter_entities([1017, 179197, 10]))
+        self.assertEqual([entity.siruta for entity in entities], [1017, 10])
+        urban = self._csv.iter_entities(self._csv.get_siruta_set(county_list=[32]),
+                                        where=lambda entity: entity.type == 1)
+        self.assertEqual([entity.siruta for entity in urban], [143450])
+        self.assertEqual(sum(1 for entity in self._csv.iter_entities()),
+                         len(self._csv._data))
+
     def test_get_inf_codes(self):
         self.assertItemsEqual(self._csv.get_inf_codes(86453), [84139])
         self.assertItemsEqual(self._csv.get_inf_codes(85984),
@@ -240,6 +421,37 @@ class TestSirutaCsv(unittest.TestCase):
         # this is an imaginary, wrong SIRUTA code
         self.assertEqual(self._csv.get_inf_codes(179197), None)
 
+    def test_iter_ndjson(self):
+        import json
+        lines = list(self._csv.iter_ndjson(fields=['name', 'county_name'],
+                                           diacritics={'nodia': True}))
+        self.assertEqual(len(lines), len(self._csv._data))
+        self.assertEqual(json.loads(lines[0]),
+                         {"siruta": 10, "name": u"JUDETUL ALBA",
+                          "county_name": u"JUDETUL ALBA"})
+        self.assertEqual(json.loads(lines[1])["siruta"], 1017)
+        self.assertEqual(self._csv.get_name(10), u"JUDEȚUL ALBA")
+        chunk = next(self._csv.iter_ndjson(encoding="utf-8"))
+        self.assertTrue(isinstance(chunk, bytes))
+        self.assertEqual(list(self._csv.iter_ndjson(fields=['foo'])), [])
+
+    def test_iter_json_tree(self):
+        import io
+        import json
+        out = io.StringIO()
+        self._csv.write_json_tree(out, fields=['name'], prefix=False)
+        tree = json.loads(out.getvalue())
+        self.assertEqual(len(tree), 42)
+        self.assertEqual(tree[0]["name"], u"ALBA")
+        self.assertEqual(tree[0]["children"][0]["siruta"], 1017)
+        self.assertEqual([child["siruta"] for child in tree[0]["children"][0]["children"]],
+                         self._csv.get_inf_codes(1017))
+        self.assertFalse("children" in tree[0]["children"][0]["children"][0])
+
+        def count(node):
+            return 1 + sum(count(child) for child in node.get("children", []))
+        self.assertEqual(sum(count(node) for node in tree), len(self._csv._data))
+
     def test_get_all_counties(self):
         self.maxDiff = None
 
@@ -269,6 +481,116 @@ class TestSirutaCsv(unittest.TestCase):
         self.assertEqual(self._csv.get_siruta_list([32], None, "SIBIU", True), [323, 143450, 143469])
         self.assertEqual(self._csv.get_siruta_list([32], None, "MUNICIPIUL SIBIU"), [143450])
 
+    def test_siruta_set(self):
+        import sirutalib
+        first = sirutalib.SirutaSet([1017, 10, 179196])
+        second = sirutalib.SirutaSet([10, 29])
+        self.assertEqual(list(first), [10, 1017, 179196])
+        self.assertEqual(len(first), 3)
+        self.assertTrue(1017 in first)
+        self.assertFalse(1026 in first)
+        self.assertEqual(list(first & second), [10])
+        self.assertEqual(list(first | second), [10, 29, 1017, 179196])
+        self.assertEqual(list(first - second), [1017, 179196])
+        self.assertFalse(sirutalib.SirutaSet())
+        self.assertEqual(sirutalib.SirutaSet([29, 10]), sirutalib.SirutaSet([10, 29]))
+
+    def test_get_siruta_set(self):
+        import sirutalib
+        urban = self._csv.get_siruta_set(region_list=[7], urban=True)
+        for code in urban:
+            self.assertEqual(self._csv.get_region(code), 7)
+            self.assertTrue(self._csv._data[code]['urban'])
+        seats = self._csv.get_siruta_set(type_list=[1, 9])
+        self.assertTrue(1026 in urban and 1026 in seats)
+        self.assertFalse(1026 in urban - seats)
+        self.assertEqual(len(urban - seats), len(urban) - len(urban & seats))
+        self.assertEqual(self._csv.get_siruta_set([1, 3, 5], [1]),
+                         sirutalib.SirutaSet([1017, 13169, 26564]))
+        self.assertEqual(self._csv.get_siruta_list([1, 3, 5], [1], as_set=True),
+                         sirutalib.SirutaSet([1017, 13169, 26564]))
+        self.assertEqual(self._csv.get_codes_by_postcode(510001, as_set=True),
+                         sirutalib.SirutaSet([1035]))
+        self.assertEqual(len(self._csv.get_siruta_set()), len(self._csv._data))
+        self.assertEqual(len(self._csv.get_siruta_set(county_list=1)), 0)
+
+    def test_query_cache(self):
+        import sirutalib
+        filename = self._write_modified_csv()
+        csv = sirutalib.SirutaDatabase(filename)
+        self.assertEqual(csv.get_query_cache_stats()['maxsize'], 0)
+        csv.set_query_cache(2)
+        first = csv.get_siruta_list([32], None, "SIBIU", True)
+        self.assertEqual(first, (323, 143450, 143469))
+        self.assertTrue(csv.get_siruta_list([32], None, "sibiu", True) is first)
+        csv.get_siruta_list([1, 3, 5], [1])
+        csv.get_siruta_list(None, None, "VADU LAT")
+        self.assertEqual(csv.get_query_cache_stats(),
+                         {'hits': 1, 'misses': 3, 'size': 2, 'maxsize': 2})
+        self.assertFalse(csv.get_siruta_list([32], None, "SIBIU", True) is first)
+
+        with open(filename, "a") as f:
+            f.write("143478;SIBIU;550001;32;143450;10;3;1;7;34;0;RO126\n")
+        csv.reload()
+        self.assertEqual(csv.get_query_cache_stats()['size'], 0)
+        self.assertEqual(csv.get_siruta_list([32], None, "SIBIU", True),
+                         (323, 143450, 143469, 143478))
+        csv.set_query_cache(0)
+        self.assertEqual(csv.get_siruta_list([1, 3, 5], [1]), [1017, 13169, 26564])
+
+    def test_count_by(self):
+        counts = self._csv.count_by(['type'])
+        self.assertEqual(counts[40], 42)
+        self.assertEqual(sum(counts.values()), len(self._csv._data))
+        counts = self._csv.count_by(['county', 'type'])
+        self.assertEqual(counts[(1, 40)], 1)
+        self.assertEqual(counts[(32, 1)], len(self._csv.get_siruta_list([32], [1])))
+        self.assertEqual(self._csv.count_by(['name']), None)
+        self.assertEqual(self._csv.count_by('type'), None)
+
+    def test_rollup(self):
+        counts = self._csv.rollup(['region', 'urban'])
+        self.assertEqual(counts[(None, None)], len(self._csv._data))
+        self.assertEqual(counts[(7, None)], counts[(7, True)] + counts[(7, False)])
+        self.assertEqual(counts[(8, True)], self._csv.count_by(['region', 'urban'])[(8, True)])
+
+    def test_count_subtree(self):
+        self.assertEqual(self._csv.count_subtree(10),
+                         self._csv.count_by(['county'])[1] - 1)
+        self.assertEqual(self._csv.count_subtree(85984), 14)
+        self.assertEqual(self._csv.count_subtree(86008), 0)
+        self.assertEqual(self._csv.count_subtree(85984, by='type'), {22: 1, 23: 13})
+        self.assertEqual(self._csv.count_subtree(179197), None)
+        self.assertEqual(self._csv.count_subtree(10, by='name'), None)
+
+    def test_rollup_values(self):
+        codes = [85984] + self._csv.get_inf_codes(85984)
+        county = self._csv.get_sup_code(85984)
+        region = self._csv.get_region(85984)
+        ret = self._csv.rollup_values(dict((code, 2) for code in codes))
+        self.assertEqual(ret, {'commune': {85984: 30}, 'county': {county: 30},
+                               'region': {region: 30}})
+        ret = self._csv.rollup_values((codes + [county, 1017, 1],
+                                       [1] * len(codes) + [5, 7, 9]),
+                                      ['county', 'commune'])
+        self.assertEqual(ret, {'county': {county: 20, 10: 7},
+                               'commune': {85984: 15, 1017: 7}})
+        self.assertEqual(self._csv.get_last_error(),
+                         "1 values have codes that are not in the database")
+        ret = self._csv.rollup_values({1026: 3, 1035: 4, 10: 1}, ['commune', 'county'],
+                                      agg=max)
+        self.assertEqual(ret, {'commune': {1017: 4}, 'county': {10: 4}})
+        self.assertEqual(self._csv.rollup_values({}, ['village']), None)
+
+    @unittest.skipIf(numpy is None, "numpy is not installed")
+    def test_rollup_values_numpy(self):
+        codes = list(self._csv._data)
+        values = numpy.arange(len(codes), dtype='i8')
+        ret = self._csv.rollup_values((numpy.array(codes + [1]),
+                                       numpy.append(values, 1)))
+        self.assertEqual(ret, self._csv.rollup_values(dict(zip(codes, values.tolist()))))
+        self.assertEqual(sum(ret['region'].values()), sum(values.tolist()))
+
     def test_diacritics_variations(self):
         self._csv.set_diacritics_params(cedilla=True, acircumflex=False)
         self.assertEqual(self._csv.get_county_string(179132),
@@ -297,6 +619,515 @@ class TestSirutaCsv(unittest.TestCase):
         finally:
             pass
 
+    def test_partial_loading(self):
+        import sirutalib
+        csv = sirutalib.SirutaDatabase(counties=[32])
+        self.assertEqual(csv.get_name(143450), u"MUNICIPIUL SIBIU")
+        self.assertEqual(csv.get_sup_name(143450), u"JUDEȚUL SIBIU")
+        self.assertEqual(csv.get_county_string(143469), u"JUDEȚUL SIBIU")
+        self.assertEqual(csv.get_name(179132), None)
+        self.assertEqual(len(csv.get_all_counties()), 42)
+        self.assertTrue(len(csv._data) < len(self._csv._data) / 10)
+        csv = sirutalib.SirutaDatabase(regions=[8])
+        self.assertEqual(csv.get_name(179196), u"BUCUREȘTI SECTORUL 6")
+        self.assertEqual(csv.get_name(143450), None)
+        self.assertEqual(csv.get_siruta_list([32], None, "SIBIU", True), [323])
+        self.assertRaises(sirutalib.SirutaCodeWarning,
+                          sirutalib.SirutaDatabase, counties=32)
+
+    @unittest.skipIf(pyarrow is None, "pyarrow is not installed")
+    def test_to_arrow(self):
+        import sirutalib
+        table = self._csv.to_arrow()
+        self.assertEqual(table.num_rows, len(self._csv._data))
+        self.assertEqual(str(table.schema.field('siruta').type), "int32")
+        self.assertTrue(pyarrow.types.is_dictionary(table.schema.field('name').type))
+        self.assertEqual(table.column('county_name')[0].as_py(), u"JUDEȚUL ALBA")
+        self.assertEqual(table.column('region_name')[0].as_py(), u"Centru")
+
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir, True)
+        filename = os.path.join(tmpdir, "siruta.arrow")
+        self._csv.to_arrow(filename)
+        csv = sirutalib.SirutaDatabase(filename)
+        self.assertEqual(len(csv._data), len(self._csv._data))
+        self.assertEqual(csv.get_name(179196), u"BUCUREȘTI SECTORUL 6")
+        self.assertEqual(csv.get_sup_name(1017, prefix=False), u"ALBA")
+        self.assertEqual(csv.get_county_string(86453), u"JUDEȚUL HARGHITA")
+        self.assertEqual(csv.get_postal_code(1035), 510001)
+        self.assertEqual(csv.get_name(179197), None)
+        self.assertEqual(csv.get_siruta_list([32], None, "SIBIU", True), [323, 143450, 143469])
+        self.assertEqual(len(sirutalib.SirutaDatabase(filename, counties=[32])._data),
+                         len(sirutalib.SirutaDatabase(counties=[32])._data))
+        del csv
+
+        filename = os.path.join(tmpdir, "siruta.parquet")
+        self._csv.to_parquet(filename)
+        from pyarrow import parquet
+        self.assertEqual(parquet.read_table(filename).num_rows, table.num_rows)
+        projected = sirutalib.SirutaDatabase(fields=['name'])
+        filename = os.path.join(tmpdir, "projected.parquet")
+        self.assertEqual(projected.to_arrow(), None)
+        self.assertEqual(projected.to_parquet(filename), None)
+        self.assertFalse(os.path.exists(filename))
+
+    @unittest.skipIf(pandas is None, "pandas is not installed")
+    def test_pandas_enrich(self):
+        import sirutalib
+        sirutalib.register_pandas_accessor()
+        df = pandas.DataFrame({'code': [1017, 179197, 86453]})
+        ret = df.siruta.enrich('code', fields=['name', 'sup_name', 'county_name',
+                                               'postal_code'], database=self._csv)
+        self.assertEqual(list(ret.columns), ['code', 'name', 'sup_name', 'county_name',
+                                             'postal_code'])
+        self.assertEqual(str(ret['name'].dtype), "category")
+        self.assertEqual(ret['name'][0], u"MUNICIPIUL ALBA IULIA")
+        self.assertEqual(ret['sup_name'][0], u"JUDEȚUL ALBA")
+        self.assertEqual(ret['county_name'][2], u"JUDEȚUL HARGHITA")
+        self.assertEqual(ret['postal_code'][0], 0)
+        self.assertTrue(pandas.isna(ret['name'][1]))
+        self.assertTrue(pandas.isna(ret['postal_code'][1]))
+        ret = df.siruta.enrich('code', fields=['county_name'], prefix=False,
+                               diacritics={'cedilla': True}, database=self._csv)
+        self.assertEqual(ret['county_name'][0], u"ALBA")
+        self.assertEqual(self._csv.get_county_string(86453), u"JUDEȚUL HARGHITA")
+        self.assertEqual(df.siruta.enrich('code', fields=['foo'], database=self._csv), None)
+
+    def _write_modified_csv(self, replacements=None, removed=None, added=None):
+        """Write a copy of the database file with a few lines changed"""
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir, True)
+        with open(self._csv._file, "r") as f:
+            lines = f.read().splitlines()
+        new_lines = []
+        for line in lines:
+            start = line.split(";")[0] + ";"
+            if start in (removed or []):
+                continue
+            if start in (replacements or {}):
+                line = line.replace(*replacements[start])
+            new_lines.append(line)
+        new_lines.extend(added or [])
+        filename = os.path.join(tmpdir, "siruta.csv")
+        with open(filename, "w") as f:
+            f.write("\n".join(new_lines) + "\n")
+        return filename
+
+    def test_parse_quoted_file(self):
+        import sirutalib
+        filename = self._write_modified_csv(
+            {"10;": (u"JUDEȚUL ALBA", u'"JUDEŢUL ALBA"'),
+             "1017;": (u"ALBA IULIA", u'ALBA IULIA "1"')})
+        csv = sirutalib.SirutaDatabase(filename)
+        self.assertEqual(len(csv._data), len(self._csv._data))
+        self.assertEqual(csv.get_name(10), u"JUDEȚUL ALBA")
+        self.assertEqual(csv.get_name(1017), u'MUNICIPIUL ALBA IULIA "1"')
+        self.assertEqual(csv._data[1026], self._csv._data[1026])
+
+    def test_parse_layouts(self):
+        import sirutalib
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir, True)
+        filename = os.path.join(tmpdir, "siruta15.csv")
+        with open(self._csv._file, "r") as f:
+            lines = f.read().splitlines()
+        with open(filename, "w") as f:
+            f.write(u"SIRUTA;DENLOC;CODP;JUD;SIRSUP;TIP;NIV;MED;REGIUNE;FSJ;"
+                    u"FS2;FS3;FSL;rang;fictiv\n")
+            for line in lines[1:]:
+                row = line.split(";")
+                fields = row[:10] + ["0", "0"] + row[10:11] + ["IV", "0"]
+                f.write(";".join(fields) + "\n")
+        csv = sirutalib.SirutaDatabase(filename)
+        self.assertEqual(len(csv._data), len(self._csv._data))
+        self.assertEqual(csv._data[1026], self._csv._data[1026])
+        self.assertEqual(csv.get_county_string(1026), u"JUDEȚUL ALBA")
+
+        csv = sirutalib.SirutaDatabase(fields=['name', 'sirutasup'])
+        self.assertEqual(csv._data[1026],
+                         {'siruta': 1026, 'name': u"ALBA IULIA",
+                          'sirutasup': 1017})
+        self.assertEqual(csv.get_sup_name(1026), u"MUNICIPIUL ALBA IULIA")
+        self.assertEqual(csv.get_county(1026), None)
+        self.assertEqual(csv.get_last_error(), "The county field was not loaded")
+        self.assertEqual(csv.get_county_string(1026), None)
+
+        filename = self._write_modified_csv(
+            {"SIRUTA;": ("REGIUNE", "ZONA")})
+        csv = sirutalib.SirutaDatabase(filename, regions=[1])
+        self.assertEqual(len(csv._data), 0)
+        self.assertEqual(csv.get_last_error(), "The header does not contain "
+                         "the columns for the fields region")
+        csv = sirutalib.SirutaDatabase(filename, fields=['name'])
+        self.assertEqual(len(csv._data), len(self._csv._data))
+        self.assertRaises(sirutalib.SirutaCodeWarning,
+                          sirutalib.SirutaDatabase, fields=['nume'])
+
+    def test_projected_fields(self):
+        import sirutalib
+        csv = sirutalib.SirutaDatabase(fields=['name', 'sirutasup'])
+        for call, ret, field in (
+                (lambda: csv.get_siruta_list([1]), [], 'county'),
+                (lambda: csv.get_siruta_list(name="SIBIU"), [143469], None),
+                (lambda: csv.get_siruta_set([1]).to_list(), [], 'county'),
+                (lambda: len(csv.get_siruta_set()), len(self._csv._data), None),
+                (lambda: csv.get_siruta_page(), None, 'county'),
+                (lambda: csv.count_by(['county']), None, 'county'),
+                (lambda: csv.rollup(['county', 'type']), None, 'county'),
+                (lambda: csv.count_subtree(10), self._csv.count_subtree(10), None),
+                (lambda: csv.count_subtree(10, by='type'), None, 'type'),
+                (lambda: csv.rollup_values(dict.fromkeys(csv._data, 1), ['county']), None, 'level'),
+                (lambda: csv.get_entity(1017), None, 'postcode'),
+                (lambda: list(csv.iter_entities()), [], 'postcode'),
+                (lambda: csv.get_label(1017), None, 'type'),
+                (lambda: csv.get_postal_code(1026, resolve=True), None, 'postcode'),
+                (lambda: csv.get_codes_by_postcode(510001), [], 'postcode'),
+                (lambda: csv.get_codes_by_postcode_prefix("51"), [], 'postcode'),
+                (lambda: csv.select("county = 1"), [], 'county'),
+                (lambda: csv.select("name = \"SIBIU\""), [143469], None),
+                (lambda: csv.suggest_codes(1016, county_hint=1), [], 'county'),
+                (lambda: csv.get_extractor(), None, 'type'),
+                (lambda: sirutalib.diff(csv, csv), None, 'postcode'),
+                (lambda: sirutalib.validate(csv), None, 'county'),
+                (lambda: sirutalib.generate_workload(csv), [], 'postcode')):
+            csv._last_error = ""
+            self.assertEqual(call(), ret)
+            if field is not None:
+                self.assertEqual(csv.get_last_error(),
+                                 "The %s field was not loaded" % field)
+        self.assertEqual(csv.get_inf_codes(1017), self._csv.get_inf_codes(1017))
+        self.assertEqual(len(list(csv.iter_ndjson(['name']))), len(csv._data))
+
+        csv = sirutalib.SirutaDatabase(fields=['name'])
+        self.assertEqual(csv.get_inf_codes(1017), None)
+        self.assertEqual(csv.get_last_error(), "The sirutasup field was not loaded")
+        self.assertEqual(list(csv.iter_ndjson(['name'])), [])
+
+    def test_history(self):
+        import sirutalib
+        newfile = self._write_modified_csv(
+            {"1026;": ("ALBA IULIA", "ALBA-IULIA"),
+             "143469;": ("550200", "550001")},
+            removed=["1035;"])
+
+        history = sirutalib.SirutaHistory([("2022-01-01", newfile),
+                                           ("2021-01-01", self._csv._file)])
+        self.assertEqual(history.get_releases(), ["2021-01-01", "2022-01-01"])
+        self.assertEqual(history.as_of("2020-06-01"), None)
+        old = history.as_of("2021-06-01")
+        new = history.as_of("2023-01-01")
+        self.assertEqual(old.get_name(1026), u"ALBA IULIA")
+        self.assertEqual(new.get_name(1026), u"ALBA-IULIA")
+        self.assertEqual(old.get_postal_code(1035), 510001)
+        self.assertEqual(new.get_postal_code(1035), None)
+        self.assertEqual(len(new._data), len(old._data) - 1)
+        self.assertEqual(new.get_county_string(1026), u"JUDEȚUL ALBA")
+        self.assertTrue(new._data[10] is old._data[10])
+        self.assertEqual(old.get_postal_code(143469), 550200)
+        self.assertEqual(new.get_postal_code(143469), 550001)
+        self.assertEqual(len(history._deltas[1][0]), 2)
+        self.assertEqual([r for r, e in history.get_versions(1035)],
+                         ["2021-01-01", "2022-01-01"])
+        self.assertEqual(history.get_versions(1035)[1][1], None)
+        first = history.as_of("2021-01-01")
+        self.assertFalse(first is history.as_of("2021-01-01"))
+        self.assertFalse(first is history._base)
+        self.assertFalse(hasattr(first._data, "__setitem__"))
+        first.set_diacritics_params(cedilla=True)
+        self.assertEqual(history.as_of("2021-01-01").get_county_string(86453),
+                         u"JUDEȚUL HARGHITA")
+        history.get_versions(1026)[0][1]['name'] = u"FOO"
+        self.assertEqual(old.get_name(1026), u"ALBA IULIA")
+        self.assertRaises(ValueError, history.add_release, "2021-06-01", newfile)
+
+    def test_diff(self):
+        import sirutalib
+        import io
+        import json
+        newfile = self._write_modified_csv(
+            {"1026;": ("ALBA IULIA", "ALBA-IULIA"),
+             "1017;": (";1;10;1;", ";1;29;1;")},
+            removed=["1035;"],
+            added=["1142;TEST;510002;1;1017;10;3;1;7;1;0;RO121"])
+        ret = sirutalib.diff(self._csv, newfile)
+        self.assertEqual(ret['added'], [1142])
+        self.assertEqual(ret['removed'], [1035])
+        self.assertEqual(ret['changed']['name'], [(1026, u"ALBA IULIA", u"ALBA-IULIA")])
+        self.assertEqual(ret['changed']['sirutasup'], [(1017, 10, 29)])
+        self.assertEqual(ret['changed']['postcode'], [])
+        self.assertEqual(len(ret['moved']), 1)
+        self.assertEqual(ret['moved'][0]['siruta'], 1017)
+        self.assertTrue(1026 in ret['moved'][0]['descendants'])
+        self.assertTrue(1142 in ret['moved'][0]['descendants'])
+        # a loop in the superior codes
+        loopfile = self._write_modified_csv({"1026;": (";1;1017;", ";1;1026;")})
+        ret = sirutalib.diff(self._csv, loopfile)
+        self.assertEqual(ret['moved'], [{'siruta': 1026, 'from': 1017, 'to': 1026,
+                                         'descendants': []}])
+
+        out = io.StringIO()
+        old_stdout, sys.stdout = sys.stdout, out
+        try:
+            self.assertEqual(sirutalib.main(["diff", self._csv._file, newfile]), 0)
+        finally:
+            sys.stdout = old_stdout
+        self.assertEqual(json.loads(out.getvalue())['removed'], [1035])
+
+    def test_compare_databases(self):
+        import sirutalib
+        import io
+        reference = sirutalib.SirutaDatabase(counties=[1, 32, 40])
+        candidate = sirutalib.SirutaDatabase(counties=[1, 32, 40])
+        candidate.compact()
+        workload = sirutalib.generate_workload(reference, samples=10)
+        getters = [call for call in workload if call[0] != 'get_siruta_list']
+        ret = sirutalib.compare_databases(reference, candidate, getters)
+        self.assertEqual(ret['mismatches'], [])
+        self.assertEqual(ret['calls'], 9 * len(getters))
+        ret = sirutalib.compare_databases(
+            reference, candidate,
+            [call for call in workload if call[0] == 'get_siruta_list'], [None])
+        self.assertEqual(ret['mismatches'], [])
+        self.assertEqual(reference._dia, reference._DIA_NEUTRAL)
+
+        out = io.StringIO()
+        sirutalib.write_workload([('get_name', [1026], {'prefix': False}),
+                                  ('get_siruta_list', [[1], [3]], {})], out)
+        out.seek(0)
+        workload = sirutalib.read_workload(out)
+        self.assertEqual(workload[0], ('get_name', [1026], {'prefix': False}))
+        self.assertRaises(ValueError, sirutalib.read_workload,
+                          io.StringIO(u'{"method": "reload"}\n'))
+
+        candidate = sirutalib.SirutaDatabase(self._write_modified_csv(
+            {"1026;": ("ALBA IULIA", "ALBA-IULIA")}))
+        ret = sirutalib.compare_databases(self._csv, candidate, workload,
+                                          modes=[(False, True, True)],
+                                          budgets={'get_siruta_list': {'latency': 0}})
+        self.assertEqual(ret['calls'], 2)
+        self.assertEqual(ret['mismatches'], [{
+            'call': ['get_name', [1026], {'prefix': False}],
+            'diacritics': (False, True, True),
+            'reference': [u"ALBA IULIA", ""],
+            'candidate': [u"ALBA-IULIA", ""]}])
+        self.assertEqual([violation['method'] for violation in ret['violations']],
+                         ['get_siruta_list'])
+
+    def test_extractor(self):
+        import sirutalib
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir, True)
+        cache = os.path.join(tmpdir, "extractor.json")
+        extractor = sirutalib.SirutaExtractor(self._csv, cache)
+        self.assertTrue(os.path.isfile(cache))
+        text = u"str. Morii nr. 3, sat Valea Mare, com. Priboieni, jud. Argeș"
+        ret = extractor.extract(text)
+        self.assertEqual([mention['siruta'] for mention in ret], [18304, 18242, 38])
+        self.assertEqual(ret[0]['text'], u"Valea Mare")
+        self.assertEqual(text[ret[2]['start']:ret[2]['end']], u"Argeș")
+
+        ret = sirutalib.SirutaExtractor(self._csv, cache).extract(
+            u"ALBA-IULIA,  jud.ALBA")
+        self.assertEqual(ret[0]['siruta'], None)
+        self.assertEqual(ret[0]['candidates'], [1017, 1026])
+        self.assertEqual(ret[1]['siruta'], 10)
+        self.assertEqual(sirutalib.SirutaExtractor(self._csv).extract(u"Sibiu"),
+                         [{'start': 0, 'end': 5, 'text': u"Sibiu", 'siruta': None,
+                           'candidates': [323, 143450, 143469]}])
+        with open(cache, "rb") as f:
+            stored = json.loads(f.read().decode('utf-8'))
+        self.assertEqual(stored['codes'], extractor._codes)
+        # a cache built from other names is not used
+        small = sirutalib.SirutaDatabase(counties=[1])
+        extractor = sirutalib.SirutaExtractor(small, cache)
+        self.assertEqual(extractor.extract(u"Priboieni"), [])
+        self.assertEqual(extractor.extract(u"Alba Iulia")[0]['candidates'], [1017, 1026])
+        self.assertTrue(self._csv.get_extractor() is self._csv.get_extractor())
+
+    def test_validate(self):
+        import sirutalib
+        import io
+        import json
+        ret = sirutalib.validate(self._csv)
+        self.assertFalse(ret['valid'])
+        self.assertEqual([code for code in self._csv._data
+                          if not self._csv.siruta_is_valid(code)],
+                         ret['errors']['checksum'])
+        self.assertTrue(sirutalib.validate(self._csv, self._csv)['valid'])
+
+        filename = self._write_modified_csv(
+            {"1017;": (";1;10;1;2;", ";1;1026;1;2;"),
+             "1035;": (";1;1017;10;3;", ";2;1017;10;2;"),
+             "1062;": (";1017;10;", ";999;10;")},
+            added=["1142;TEST;1",
+                   u"1044;MICEȘTI;510002;1;1017;10;3;1;7;1;0;RO121"])
+        ret = sirutalib.validate(filename, self._csv)
+        self.assertFalse(ret['valid'])
+        self.assertEqual(ret['entities'], len(self._csv._data))
+        errors = ret['errors']
+        self.assertEqual(errors['checksum'], [])
+        self.assertEqual(ret['known_checksum'],
+                         sirutalib.validate(self._csv)['errors']['checksum'])
+        self.assertEqual(len(errors['rows']), 2)
+        self.assertEqual(errors['rows'][1], "SIRUTA code 1044 appears more than once")
+        self.assertEqual(errors['missing_parent'], [1062])
+        self.assertEqual(errors['cycles'], [[1017, 1026]])
+        self.assertEqual(errors['county_mismatch'], [(1035, 2, 1)])
+        self.assertEqual(errors['invalid_type'], [])
+        self.assertEqual(errors['invalid_level'], [(1035, 10, '2')])
+        self.assertEqual(errors['invalid_parent_type'], [(1017, 1, 9)])
+
+        out = io.StringIO()
+        old_stdout, sys.stdout = sys.stdout, out
+        try:
+            self.assertEqual(sirutalib.main(["validate", filename, "--previous",
+                                             self._csv._file]), 1)
+        finally:
+            sys.stdout = old_stdout
+        self.assertEqual(json.loads(out.getvalue())['errors']['missing_parent'], [1062])
+
+    def test_compact(self):
+        import sirutalib
+        csv = sirutalib.SirutaDatabase(counties=[1, 32, 40])
+        reference = sirutalib.SirutaDatabase(counties=[1, 32, 40])
+        csv.compact()
+        self.assertEqual(list(csv._data), list(reference._data))
+        for code in reference._data:
+            self.assertEqual(csv._data[code], reference._data[code])
+        self.assertEqual(csv.get_name(143450, prefix=False), u"SIBIU")
+        self.assertEqual(csv.get_county_string(179196), u"MUNICIPIUL BUCUREȘTI")
+        self.assertEqual(csv.get_siruta_list([32], None, "SIBIU", True), [323, 143450, 143469])
+        entity = csv.get_entity(143450)
+        self.assertTrue(entity._index is not None)
+        self.assertEqual(entity, reference.get_entity(143450))
+        self.assertEqual(entity.county_name, u"JUDEȚUL SIBIU")
+        self.assertEqual([entity.siruta for entity in csv.iter_entities([143450, 1, 10])],
+                         [143450, 10])
+        self.assertEqual(list(csv.iter_entities()), list(reference.iter_entities()))
+
+    def test_front_coded_dictionary(self):
+        import sirutalib
+        names = [u"VALEA MARE", u"VALEA MICĂ", u"VALEA MARE", u"ALBA", u"ȘIMONEȘTI",
+                 u"VALEA LUNGĂ", u"BUCUREȘTI SECTORUL 1", u"BUCUREȘTI SECTORUL 2"]
+        dictionary = sirutalib._FrontCodedDictionary(names, block_size=3)
+        self.assertEqual(len(dictionary), 7)
+        self.assertEqual(list(dictionary), sorted(set(names), key=lambda n: n.encode('utf-8')))
+        for name in names:
+            self.assertEqual(dictionary[dictionary.find(name)], name)
+        self.assertEqual(dictionary.find(u"VALEA"), -1)
+        self.assertEqual(dictionary.find(u"AAA"), -1)
+        loaded = sirutalib._FrontCodedDictionary.from_buffer(dictionary.to_bytes())
+        self.assertEqual(list(loaded), list(dictionary))
+        self.assertEqual(loaded.find(u"VALEA MICĂ"), dictionary.find(u"VALEA MICĂ"))
+
+    def test_code_index(self):
+        import sirutalib
+        codes = list(self._csv._data)
+        index = sirutalib._CodeIndex(codes)
+        self.assertEqual(len(index), len(codes))
+        self.assertEqual(index.get(codes[0]), 0)
+        self.assertEqual(index.get(179196), codes.index(179196))
+        self.assertEqual(index.get(1016), None)
+        self.assertEqual(index.get(9), None)
+        self.assertEqual(index.get(10 ** 6, -1), -1)
+        self.assertFalse("1017" in index)
+        self.assertEqual(index.get_many([1017, 1, 1026]), [1, None, 2])
+        self.assertEqual(index.get_many([1017.0, 1017.5, float("nan"), float("inf")]),
+                         [1, None, None, None])
+        csv = sirutalib.SirutaDatabase(counties=[1])
+        csv.compact()
+        self.assertEqual(csv.get_name(1017.0), self._csv.get_name(1017.0))
+        self.assertEqual(csv.get_name(1017.5), None)
+        loaded = sirutalib._CodeIndex.from_buffer(index.to_bytes())
+        self.assertEqual(loaded.get_many(codes), list(range(len(codes))))
+        self.assertEqual(loaded.get(1016), None)
+        large = sirutalib._CodeIndex(list(range(10, 70010)))
+        self.assertEqual(large.get(70009), 69999)
+        self.assertEqual(sirutalib._CodeIndex.from_buffer(large.to_bytes()).get(10), 0)
+
+    def test_shared_memory(self):
+        import sirutalib
+        import multiprocessing
+        store = sirutalib.SirutaSharedMemory(self._csv)
+        try:
+            csv = sirutalib.attach_shared_database(store.name)
+            self.assertEqual(len(csv._data), len(self._csv._data))
+            self.assertTrue(isinstance(csv._data._columns['name'], sirutalib._NameColumn))
+            self.assertEqual(list(csv._data._columns['name']),
+                             [entry['name'] for entry in self._csv._data.values()])
+            self.assertEqual(csv._data[1017], self._csv._data[1017])
+            self.assertEqual(csv.get_county_string(86453), u"JUDEȚUL HARGHITA")
+            self.assertEqual(csv.get_sup_name(1017, prefix=False), u"ALBA")
+            self.assertEqual(csv.get_name(179197), None)
+            self.assertEqual(csv.get_siruta_list([32], None, "SIBIU", True),
+                             [323, 143450, 143469])
+            view = csv._view()
+            sirutalib.detach_shared_database(csv)
+            self.assertEqual(csv._shared, None)
+            self.assertEqual(len(view._data), 0)
+            self.assertEqual(view.get_name(1017), None)
+            sirutalib.detach_shared_database(csv)
+
+            pool = multiprocessing.Pool(2)
+            try:
+                ret = pool.map(_shared_database_names,
+                               [(store.name, [10, 1017]), (store.name, [179196])])
+            finally:
+                pool.close()
+                pool.join()
+            self.assertEqual(ret, [[u"JUDEȚUL ALBA", u"MUNICIPIUL ALBA IULIA"],
+                                   [u"BUCUREȘTI SECTORUL 6"]])
+
+            # a process with its own resource tracker must not destroy the block
+            import subprocess
+            subprocess.check_call([sys.executable, "-c",
+                                   "import sirutalib; sirutalib.detach_shared_database("
+                                   "sirutalib.attach_shared_database(%r, track=False))"
+                                   % store.name],
+                                  cwd=os.path.dirname(os.path.abspath(sirutalib.__file__)))
+            csv = sirutalib.attach_shared_database(store.name)
+            self.assertEqual(csv.get_name(10), u"JUDEȚUL ALBA")
+            sirutalib.detach_shared_database(csv)
+        finally:
+            store.close()
+        store.close()
+        store = sirutalib.SirutaSharedMemory(self._csv)
+        store._shm.unlink()
+        store.close()
+
+    def test_get_default_database(self):
+        import sirutalib
+        import threading
+        views = []
+        threads = [threading.Thread(target=lambda: views.append(
+            sirutalib.get_default_database())) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(views), 4)
+        for view in views[1:]:
+            self.assertTrue(view._data is views[0]._data)
+        views[0].set_diacritics_params(cedilla=True)
+        self.assertEqual(views[0].get_county_string(86453), u"JUDEŢUL HARGHITA")
+        self.assertEqual(views[1].get_county_string(86453), u"JUDEȚUL HARGHITA")
+        self.assertTrue(sirutalib.get_default_database(counties=[32])._data
+                        is sirutalib.get_default_database(counties=[32])._data)
+        self.assertFalse(sirutalib.get_default_database(counties=[32])._data
+                         is views[0]._data)
+        projected = sirutalib.get_default_database(fields=['name'])
+        self.assertEqual(projected._loaded_fields, ['siruta', 'name'])
+        same = sirutalib.get_default_database(fields=['name'])
+        self.assertTrue(projected._data is same._data)
+        self.assertRaises(sirutalib.SirutaCodeWarning,
+                          sirutalib.get_default_database, counties=set([32]))
+        views[0].set_query_cache(4)
+        views[0].get_siruta_list([32])
+        self.assertEqual(views[0].get_query_cache_stats()['size'], 1)
+        self.assertEqual(views[1].get_query_cache_stats()['maxsize'], 0)
+        views[1].set_query_cache(4)
+        self.assertEqual(views[0].get_query_cache_stats()['size'], 1)
+
 
 if __name__ == '__main__':
     unittest.main()